@@ -1,8 +1,12 @@
 import argparse
 import json
 import os
+import sys
 from lxml import etree as ET
 
+# the PubMed index lives in the sibling pubmed_indexer directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pubmed_indexer"))
+
 # function to get pmids from the dataset
 def get_dataset_pmids(dataset_loc):
     dataset = None
@@ -57,6 +61,21 @@ def map_abstracts_to_ids(pmids, database_dir):
 
     return pmid_abstract_dict
 
+# function to get abstracts for each pmid from the PubMed index instead of rescanning every shard
+def map_abstracts_to_ids_from_index(pmids, index_dir):
+    from PubmedIndexer import PubmedIndexer
+    pubmed_indexer = PubmedIndexer()
+    pubmed_indexer.mk_index(indexpath=index_dir)
+    articles = pubmed_indexer.get_by_pmid(pmids)
+    pmid_abstract_dict = dict()
+    for id, article in articles.items():
+        if article.title is None or article.abstract_text is None:
+            print(f"no abstract OR title for PMID {id}")
+            continue
+        pmid_abstract_dict[id] = (article.title, article.abstract_text)
+    print(f"found {len(pmid_abstract_dict)} / {len(pmids)} pmids in the index")
+    return pmid_abstract_dict
+
 # function to add the found abstracts to the dataset
 def add_full_abstracts(old_dataset, pmid_abstract_dict, new_dataset):
     print(f"adding full_abstracts to {old_dataset}")
@@ -88,12 +107,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_data", help="The filepath to the qa data (e.g. data/training8b.json")
     parser.add_argument("path_to_pubmed_dir", help="The filepath to the directory containing PubMed (e.g. the .xml.gz files, not the pubmed index") 
+    parser.add_argument("-i", "--index", dest="index_dir", help="The filepath to a PubMed index, used instead of rescanning the .xml.gz files") 
 
     args = parser.parse_args()
     path_to_data = args.path_to_data
     path_to_pubmed_dir = args.path_to_pubmed_dir
 
     pmids = get_dataset_pmids(path_to_data)
-    pmids_to_abstracts = map_abstracts_to_ids(pmids, path_to_pubmed_dir)
+    if args.index_dir:
+        pmids_to_abstracts = map_abstracts_to_ids_from_index(pmids, args.index_dir)
+    else:
+        pmids_to_abstracts = map_abstracts_to_ids(pmids, path_to_pubmed_dir)
     add_full_abstracts(path_to_data, pmids_to_abstracts, path_to_data)
 
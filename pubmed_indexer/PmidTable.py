@@ -0,0 +1,69 @@
+"""
+This module implements the class PmidTable, a sorted PMID -> Whoosh document
+ number table that is built at index time and memory mapped at lookup time
+"""
+import bisect
+import mmap
+import struct
+from array import array
+
+# file layout: a header of two unsigned 64 bit ints (index doc count, n)
+#   followed by n sorted uint32 PMIDs and then the n matching uint32 docnums
+HEADER_FORMAT = "<QQ"
+ENTRY_FORMAT = "I"
+
+
+class PmidTable:
+    """
+    Looks up the Whoosh document number of a PMID with a binary search over
+    the memory mapped table, so only a handful of pages are ever touched
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.doc_count, size = struct.unpack_from(HEADER_FORMAT, self.buffer)
+        self.view = memoryview(self.buffer)[struct.calcsize(HEADER_FORMAT):]
+        self.body = self.view.cast(ENTRY_FORMAT)
+        self.pmids = self.body[:size]
+        self.docnums = self.body[size:2 * size]
+        assert len(self.docnums) == size, "truncated PMID table " + path
+
+    @staticmethod
+    def write(path: str, doc_count: int, pmids: array, docnums: array) -> None:
+        """
+        writes a table, pmids must already be sorted in ascending order
+        """
+        with open(path, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, doc_count, len(pmids)))
+            pmids.tofile(f)
+            docnums.tofile(f)
+
+    def is_current(self, doc_count: int) -> bool:
+        """
+        the table is only valid for the index it was built from
+        """
+        return self.doc_count == doc_count
+
+    def lookup(self, pmid):
+        """
+        returns the document number for the pmid or None if it is not in
+        the table
+        """
+        try:
+            value = int(pmid)
+        except (TypeError, ValueError):
+            return None
+        i = bisect.bisect_left(self.pmids, value)
+        if i < len(self.pmids) and self.pmids[i] == value:
+            return self.docnums[i]
+        return None
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def close(self) -> None:
+        for view in (self.pmids, self.docnums, self.body, self.view):
+            view.release()
+        self.buffer.close()
+        self.file.close()
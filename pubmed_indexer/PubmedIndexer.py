@@ -4,13 +4,17 @@ This module indexes the Pubmed dataset using Whoosh
 import os
 import os.path
 import argparse
+import re
 import shutil
+from array import array
 from whoosh import index
 from whoosh.fields import Schema, TEXT, IDLIST, ID, NUMERIC
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.qparser import QueryParser
 from PubmedReader import PubmedReader
 from PubmedArticle import PubmedArticle
+from PubmedPassage import PubmedPassage
+from PmidTable import PmidTable
 from datetime import datetime
 from typing import List
 
@@ -25,6 +29,134 @@ from typing import List
 #      ...but then, that crashed too, so setting it to 8000000, then crashed so, decreasing
 #      it to 4000000
 COMMIT_THRESHOLD = 4000000
+# The passage writer commits together with the article writer, so COMMIT_THRESHOLD
+#   counts articles for both indexes. The overflow above is a segment growing past
+#   4 GiB (4294967519 does not fit in a 32 bit array), which depends on the text a
+#   segment holds, not on its document count. The passages of COMMIT_THRESHOLD
+#   articles hold the same title and abstract text as the article segment, split
+#   over ~10x more (smaller) documents, so a passage segment stays about as large
+#   as an article segment and the passage index gets as many segments.
+
+# The optional passage index lives next to the article index (same directory)
+#   and holds one document per sentence (or per group of sentences) with the
+#   PMID of the parent article, so snippets can be searched for directly
+PASSAGE_INDEX_NAME = "pubmed_passages"
+# sorted PMID -> document number table written next to the article index
+PMID_TABLE_NAME = "pubmed_articles_pmids.bin"
+# a sentence ends at ./!/? followed by whitespace and an upper case letter,
+#   digit or bracket. This is cheap and good enough for abstracts.
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])")
+
+
+def split_passages(text: str, sentences_per_passage: int = 1) -> List[tuple]:
+    """
+    splits text into passages of sentences_per_passage sentences
+
+    Returns
+    -------
+    List[tuple]
+        (character offset, passage text) for each passage
+    """
+    if not text:
+        return []
+    spans = []
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(text):
+        spans.append((start, boundary.start()))
+        start = boundary.end()
+    spans.append((start, len(text)))
+    passages = []
+    for i in range(0, len(spans), sentences_per_passage):
+        group = spans[i:i + sentences_per_passage]
+        begin, end = group[0][0], group[-1][1]
+        passages.append((begin, text[begin:end]))
+    return passages
+
+
+def open_pmid_table(indexpath: str):
+    """
+    opens the PMID table mk_pmid_table wrote in indexpath
+
+    Returns
+    -------
+    PmidTable
+        The table, None when the index has none
+    """
+    table_path = os.path.join(indexpath, PMID_TABLE_NAME)
+    if os.path.exists(table_path):
+        return PmidTable(table_path)
+    return None
+
+
+def stored_fields_by_pmid(article_ix, pmid_table, pmids: List[str]) -> dict:
+    """
+    looks up the stored fields of articles by PMID in one batch, through the
+    PMID table when it matches the index and by the pmid term otherwise
+
+    Returns
+    -------
+    dict
+        PMID -> stored fields, PMIDs that are not in the index are left out
+    """
+    res = {}
+    with article_ix.searcher() as s:
+        use_table = (pmid_table is not None and
+                     pmid_table.is_current(s.doc_count_all()))
+        for pmid in pmids:
+            if use_table:
+                docnum = pmid_table.lookup(pmid)
+            else:
+                # no (or stale) table, fall back to a term lookup
+                docnum = s.document_number(pmid=str(pmid))
+            if docnum is None:
+                continue
+            res[str(pmid)] = s.stored_fields(docnum)
+    return res
+
+
+def passage_hits(results, article_searcher) -> tuple:
+    """
+    pairs passage index hits with their parent articles
+
+    Parameters
+    ----------
+    results: whoosh Results
+        The hits of a search of the passage index
+    article_searcher: whoosh Searcher
+        A searcher of the article index the passages were split from
+
+    Returns
+    -------
+    tuple
+        (List[(stored fields, score)] of the passages in rank order,
+        List[stored fields] of the articles, unique and ordered by their
+        best ranked passage)
+    """
+    passages = []
+    articles = []
+    seen_pmids = set()
+    for result in results:
+        passages.append((result.fields(), result.score))
+        pmid = result['pmid']
+        if pmid in seen_pmids:
+            continue
+        seen_pmids.add(pmid)
+        doc = article_searcher.document(pmid=pmid)
+        if doc:
+            articles.append(doc)
+    return passages, articles
+
+
+def stored_article(fields: dict) -> PubmedArticle:
+    """
+    builds a PubmedArticle from the stored fields of an article index document
+    """
+    return PubmedArticle(fields['pmid'],
+                         fields['title'],
+                         fields['journal'],
+                         fields['year'],
+                         fields['abstract_text'],
+                         fields['mesh_major'])
 
 
 class PubmedIndexer:
@@ -78,10 +210,12 @@ class PubmedIndexer:
         """
         default construstor it does nothing at the moment
         """
-        pass
+        self.pubmed_passage_ix = None
+        self.pmid_table = None
 
     def mk_index(self, indexpath: str = "indexdir",
-                 overwrite: bool = False) -> None:
+                 overwrite: bool = False, passages: bool = False,
+                 sentences_per_passage: int = 1) -> None:
         """
         creates a Whoosh based index for subsequent IR operatons
 
@@ -94,11 +228,25 @@ class PubmedIndexer:
         overwrite: boolean
             This will overwrite any existing index (directory) if set to True
             The default value is set to False (safe setting)
+        passages: boolean
+            Also create the passage index, whose unit is a sentence or
+            fixed-size group of sentences with a parent PMID. An existing
+            passage index is opened whether or not this is set.
+        sentences_per_passage: int
+            The number of sentences in each passage of the passage index
+
+        Raises
+        ------
+        ValueError
+            If passages is set for an existing article index that was built
+            without a passage index. Passages are only written while the
+            articles are indexed, so rebuild it with overwrite=True.
 
         Returns:
         None
             it is a void method and returns the None value
         """
+        self.indexpath = indexpath
         use_existing_index = True
         if os.path.exists(indexpath):
             if overwrite:
@@ -123,6 +271,24 @@ class PubmedIndexer:
         else:
             self.pubmed_article_ix = index.open_dir(
                 indexpath, indexname="pubmed_articles")
+        self.sentences_per_passage = sentences_per_passage
+        if index.exists_in(indexpath, indexname=PASSAGE_INDEX_NAME):
+            self.pubmed_passage_ix = index.open_dir(
+                indexpath, indexname=PASSAGE_INDEX_NAME)
+            print("passage index object opened")
+        elif passages and use_existing_index:
+            raise ValueError(
+                f"{indexpath} has no passage index, rebuild it with overwrite=True to index passages")
+        elif passages:
+            self.pubmed_passage_ix = index.create_in(
+                indexpath,
+                Schema(
+                    pmid=ID(stored=True),
+                    section=ID(stored=True),
+                    offset=NUMERIC(stored=True),
+                    passage_text=TEXT(stored=True, analyzer=StemmingAnalyzer())),
+                indexname=PASSAGE_INDEX_NAME)
+            print("passage index object created")
         print("index object created")
 
     def rm_index(self, indexpath: str = "indexdir") -> None:
@@ -162,8 +328,13 @@ class PubmedIndexer:
         """
         print("adding documents")
         pubmed_article_writer = self.pubmed_article_ix.writer()
+        pubmed_passage_writer = None
+        if self.pubmed_passage_ix is not None:
+            # passages are written in the same pass over the shards
+            pubmed_passage_writer = self.pubmed_passage_ix.writer()
         count_from_commit = 0
         total_count = 0
+        total_passages = 0
         for article in articles:
             count_from_commit += 1
             total_count += 1
@@ -174,6 +345,14 @@ class PubmedIndexer:
                 mesh_major=article.mesh_major,
                 year=article.year,
                 abstract_text=article.abstract_text)
+            if pubmed_passage_writer is not None:
+                for passage in self.article_passages(article):
+                    pubmed_passage_writer.add_document(
+                        pmid=passage.pmid,
+                        section=passage.section,
+                        offset=passage.offset,
+                        passage_text=passage.passage_text)
+                    total_passages += 1
 
             #perform intermediate commits to avoid overflow errors
             if count_from_commit > COMMIT_THRESHOLD:
@@ -182,13 +361,81 @@ class PubmedIndexer:
                 pubmed_article_writer = self.pubmed_article_ix.writer()
                 count_from_commit = 0
                 print ("   committing, current total_count = ", total_count)
+                if pubmed_passage_writer is not None:
+                    pubmed_passage_writer.commit(merge=False)
+                    pubmed_passage_writer = self.pubmed_passage_ix.writer()
+                    print ("   committing passages, current total_passages = ", total_passages)
                 
         # perform the final commit
         pubmed_article_writer.commit()
+        if pubmed_passage_writer is not None:
+            pubmed_passage_writer.commit()
         #Note: I think .commit(optimize=True) is the correct way to do this final commit
         #      but it causes the program to crash
         #      (OverflowError: 4294967519 is too big to fit in an array)
         print("commiting index, added", total_count, "documents")
+        if pubmed_passage_writer is not None:
+            print("commiting passage index, added", total_passages, "passages")
+        # document numbers are only stable once the last commit is done
+        self.mk_pmid_table()
+
+    def mk_pmid_table(self) -> None:
+        """
+        builds the sorted PMID -> document number table used by get_by_pmid
+        It reads the pmid term dictionary, not the stored fields, so this is
+        quick enough to also run against an existing index
+
+        Returns
+        -------
+        None
+            This void method return nothing
+        """
+        if self.pmid_table is not None:
+            self.pmid_table.close()
+            self.pmid_table = None
+        # the lexicon is in byte order, so bucket the PMIDs by number of
+        #   digits and each bucket is already in numeric order
+        pmid_buckets = {}
+        docnum_buckets = {}
+        with self.pubmed_article_ix.reader() as reader:
+            doc_count = reader.doc_count_all()
+            for term in reader.lexicon("pmid"):
+                if not term.isdigit():
+                    continue
+                digits = len(term)
+                if digits not in pmid_buckets:
+                    pmid_buckets[digits] = array("I")
+                    docnum_buckets[digits] = array("I")
+                pmid_buckets[digits].append(int(term))
+                docnum_buckets[digits].append(reader.first_id("pmid", term))
+        pmids = array("I")
+        docnums = array("I")
+        for digits in sorted(pmid_buckets):
+            pmids.extend(pmid_buckets[digits])
+            docnums.extend(docnum_buckets[digits])
+        PmidTable.write(os.path.join(self.indexpath, PMID_TABLE_NAME),
+                        doc_count, pmids, docnums)
+        print("PMID table written,", len(pmids), "PMIDs")
+
+    def get_by_pmid(self, pmids: List[str]) -> dict:
+        """
+        fetches articles by PMID in one batch
+
+        Parameters
+        ----------
+        pmids: List[str]
+            The PMIDs of the articles to fetch
+
+        Returns
+        -------
+        dict
+            PMID -> PubmedArticle, PMIDs that are not in the index are left out
+        """
+        if self.pmid_table is None:
+            self.pmid_table = open_pmid_table(self.indexpath)
+        found = stored_fields_by_pmid(self.pubmed_article_ix, self.pmid_table,
+                                      pmids)
+        return {pmid: stored_article(fields) for pmid, fields in found.items()}
 
     def search(self, query,
                max_results: int = 10) -> List[PubmedArticle]:
@@ -220,6 +467,62 @@ class PubmedIndexer:
                 res.append(pa)
             return res
 
+    def article_passages(self, article: PubmedArticle) -> List[PubmedPassage]:
+        """
+        splits the title and abstract of an article into passages for
+        the passage index. The title is always a single passage.
+        """
+        passages = []
+        if article.title:
+            passages.append(
+                PubmedPassage(article.pmid, "title", 0, article.title))
+        for offset, text in split_passages(article.abstract_text,
+                                           self.sentences_per_passage):
+            passages.append(
+                PubmedPassage(article.pmid, "abstract", offset, text))
+        return passages
+
+    def search_passages(self, query,
+                        max_results: int = 10) -> tuple:
+        """
+        queries the passage index and returns the ranked passages along
+        with their parent articles
+
+        Parameters
+        ----------
+        query: str
+           This is a plain text query string that Whoosh searches
+           the passage index for matches
+        max_results: int
+           This parameter sets the maximum number of passages the
+           method will return
+
+        Returns
+        -------
+        tuple
+            (List[PubmedPassage], List[PubmedArticle]), the articles are
+            unique and ordered by their best ranked passage
+
+        Raises
+        ------
+        ValueError
+            If the index was built without a passage index
+        """
+        if self.pubmed_passage_ix is None:
+            raise ValueError(
+                f"{self.indexpath} has no passage index, build it with passages=True")
+        qp = QueryParser("passage_text", schema=self.pubmed_passage_ix.schema)
+        q = qp.parse(query)
+        with self.pubmed_passage_ix.searcher() as ps, \
+                self.pubmed_article_ix.searcher() as s:
+            hits, docs = passage_hits(ps.search(q, limit=max_results), s)
+        passages = [PubmedPassage(fields['pmid'],
+                                  fields['section'],
+                                  fields['offset'],
+                                  fields['passage_text'])
+                    for fields, _ in hits]
+        return passages, [stored_article(doc) for doc in docs]
+
     def print_results(results):
         """
         simple utility method to print search results to the console
@@ -241,10 +544,12 @@ class PubmedIndexer:
 
 
 #generates new pubmed index
-def generate_new_index(index_location,db_location):
+def generate_new_index(index_location,db_location,passages=False,sentences_per_passage=1):
     print("now", datetime.now())
     pubmed_indexer = PubmedIndexer()
-    pubmed_indexer.mk_index(indexpath=index_location,overwrite=True)
+    pubmed_indexer.mk_index(indexpath=index_location,overwrite=True,
+                            passages=passages,
+                            sentences_per_passage=sentences_per_passage)
     reader = PubmedReader()
     print("now", datetime.now())
     print("starting reader")
@@ -270,9 +575,24 @@ def test_with_existing_index():
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("pubmed", help="The path where Pubmed is stored.")
+    parser.add_argument("pubmed", nargs="?",
+                        help="The path where Pubmed is stored, not needed with --pmid_table_only.")
     parser.add_argument("index", help="The path where the index will be saved.")
+    parser.add_argument("-p", "--passages", action="store_true",
+                        help="Also build the sentence/passage index used for snippet retrieval.")
+    parser.add_argument("-s", "--sentences_per_passage", type=int, default=1,
+                        help="The number of sentences in each passage of the passage index.")
+
+    parser.add_argument("-t", "--pmid_table_only", action="store_true",
+                        help="Only (re)build the PMID lookup table of an existing index.")
 
     args = parser.parse_args()
+    if args.pubmed is None and not args.pmid_table_only:
+        parser.error("the pubmed path is required to build the index")
     print (f"Index Location: {args.index},Pubmed DB Location: {args.pubmed}")
-    generate_new_index(args.index,args.pubmed)
+    if args.pmid_table_only:
+        pubmed_indexer = PubmedIndexer()
+        pubmed_indexer.mk_index(indexpath=args.index)
+        pubmed_indexer.mk_pmid_table()
+    else:
+        generate_new_index(args.index,args.pubmed,args.passages,args.sentences_per_passage)
@@ -0,0 +1,14 @@
+"""
+This module implements the class PubmedPassage which holds a single
+ sentence (or fixed-size group of sentences) from a pubmed article
+"""
+
+
+class PubmedPassage:
+
+    def __init__(self, pmid: str, section: str, offset: int,
+                 passage_text: str):
+        self.pmid = pmid
+        self.section = section
+        self.offset = offset
+        self.passage_text = passage_text
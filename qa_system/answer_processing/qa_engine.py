@@ -0,0 +1,552 @@
+"""
+qa_engine.py runs the BioBERT question answering models in-process.
+
+Each QAEngine builds its runner's (run_factoid.py, run_list.py or run_yesno.py) inference graph once, restores the
+fine-tuned checkpoint once and keeps the session open, so answering a question costs one forward pass instead of
+a new interpreter, a TensorFlow import, an Estimator, a graph build and a checkpoint restore.
+
+The runners' own create_model, convert_examples_to_features and write_predictions are reused, so the answers and
+output files are the same as the ones the runner scripts produce.
+"""
+import warnings
+warnings.filterwarnings('ignore')
+
+from utils import *
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+# the runners import modeling, optimization and tokenization as top level modules
+ANSWER_PROCESSING_DIR = os.path.dirname(os.path.abspath(__file__))
+if ANSWER_PROCESSING_DIR not in sys.path:
+    sys.path.append(ANSWER_PROCESSING_DIR)
+
+QUESTION_TYPES = ("factoid", "list", "yesno")
+RUNNERS = {"factoid": "run_factoid", "list": "run_list", "yesno": "run_yesno"}
+BERT_MODELS_DIR = "bert_models"
+# the batch mode QA input file of each question type, under tmp/qa/<question type>/
+INPUT_FILES = {"factoid": "qa_factoids.json", "list": "qa_list.json", "yesno": "qa_yesno.json"}
+
+# the runners' modules, keyed by question type, and the absl flags each of them defined
+runners = {}
+runner_flags = {}
+
+
+# Import the runner script for question_type as a module.
+# Every runner defines the same absl flags at import time, which absl refuses to define twice, so the flags
+# of the runners imported before are dropped first. The runners only read flags whose defaults they all share
+# (do_lower_case, verbose_logging, version_2_with_negative, null_score_diff_threshold), so they keep working.
+def import_runner(question_type):
+    if question_type in runners:
+        return runners[question_type]
+    import tensorflow as tf
+    flag_values = tf.flags.FLAGS
+    for names in runner_flags.values():
+        for name in names:
+            if name in flag_values:
+                delattr(flag_values, name)
+    before = set(flag_values)
+    runner = importlib.import_module(RUNNERS[question_type])
+    runner_flags[question_type] = set(flag_values) - before
+    # nothing is parsed from the command line in-process, the flag defaults are used
+    flag_values.mark_as_parsed()
+    runners[question_type] = runner
+    return runner
+
+
+# Set the feature conversion and answer selection options every engine reads on engine
+def init_options(engine, max_seq_length, doc_stride, max_query_length, predict_batch_size, n_best_size,
+                 max_answer_length, do_lower_case):
+    engine.max_seq_length = max_seq_length
+    engine.doc_stride = doc_stride
+    engine.max_query_length = max_query_length
+    engine.predict_batch_size = predict_batch_size
+    engine.n_best_size = n_best_size
+    engine.max_answer_length = max_answer_length
+    engine.do_lower_case = do_lower_case
+
+
+# Split a context into words on the same whitespace the runners' read_squad_examples splits on
+def doc_tokens_from_text(paragraph_text):
+    doc_tokens = []
+    prev_is_whitespace = True
+    for c in paragraph_text:
+        if c in " \t\r\n" or ord(c) == 0x202F:
+            prev_is_whitespace = True
+        else:
+            if prev_is_whitespace:
+                doc_tokens.append(c)
+            else:
+                doc_tokens[-1] += c
+            prev_is_whitespace = False
+    return doc_tokens
+
+
+# Parse the SQuAD style json built by question_answering.get_json_from_data into the runner's examples,
+# the same way the runner's read_squad_examples does for prediction
+def read_examples(runner, question_type, json_data):
+    examples = []
+    for entry in json_data["data"]:
+        for paragraph in entry["paragraphs"]:
+            doc_tokens = doc_tokens_from_text(paragraph["context"])
+            for qa in paragraph["qas"]:
+                if question_type == "yesno":
+                    example = runner.SquadExample(
+                        qas_id=qa["id"], question_text=qa["question"], doc_tokens=doc_tokens, answer=None
+                    )
+                else:
+                    example = runner.SquadExample(
+                        qas_id=qa["id"], question_text=qa["question"], doc_tokens=doc_tokens
+                    )
+                examples.append(example)
+    return examples
+
+
+def convert_examples(runner, examples, tokenizer, max_seq_length, doc_stride, max_query_length):
+    features = []
+    runner.convert_examples_to_features(
+        examples=examples,
+        tokenizer=tokenizer,
+        max_seq_length=max_seq_length,
+        doc_stride=doc_stride,
+        max_query_length=max_query_length,
+        is_training=False,
+        output_fn=features.append,
+    )
+    return features
+
+
+# The runner's RawResult for the j-th feature of a batch, outputs holds the batch's logits under the runner's names
+def raw_result(runner, question_type, feature, outputs, j):
+    if question_type == "yesno":
+        return runner.RawResult(
+            unique_id=feature.unique_id,
+            logits=[float(x) for x in outputs["logits"][j].flat],
+        )
+    return runner.RawResult(
+        unique_id=feature.unique_id,
+        start_logits=[float(x) for x in outputs["start_logits"][j].flat],
+        end_logits=[float(x) for x in outputs["end_logits"][j].flat],
+    )
+
+
+# Write the runner's prediction files to output_dir (a temporary folder when it is None) and read them back
+# Returns (predictions, nbest), nbest is None for yesno questions
+def write_outputs(runner, question_type, examples, features, results, n_best_size, max_answer_length,
+                  do_lower_case, output_dir=None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = output_dir if output_dir is not None else tmp_dir
+        os.makedirs(out_dir, exist_ok=True)
+        prediction_file = os.path.join(out_dir, "predictions.json")
+        nbest_file = os.path.join(out_dir, "nbest_predictions.json")
+        runner.write_predictions(
+            examples, features, results, n_best_size, max_answer_length, do_lower_case,
+            prediction_file, nbest_file, os.path.join(out_dir, "null_odds.json"),
+        )
+        with open(prediction_file, "r") as f:
+            predictions = json.load(f)
+        nbest = None
+        if question_type != "yesno":
+            with open(nbest_file, "r") as f:
+                nbest = json.load(f)
+    return predictions, nbest
+
+
+def parameter_bytes(graph):
+    with graph.as_default():
+        import tensorflow as tf
+        return sum(v.shape.num_elements() * v.dtype.base_dtype.size for v in tf.global_variables())
+
+
+class QAEngine:
+
+    def __init__(self, question_type, bert_dir=BERT_MODELS_DIR, init_checkpoint=None, max_seq_length=384,
+                 doc_stride=128, max_query_length=64, predict_batch_size=8, n_best_size=20,
+                 max_answer_length=30, do_lower_case=True, session_config=None, finalize=True):
+        import tensorflow as tf
+        start = time.perf_counter()
+        self.question_type = question_type
+        self.runner = import_runner(question_type)
+        init_options(self, max_seq_length, doc_stride, max_query_length, predict_batch_size, n_best_size,
+                     max_answer_length, do_lower_case)
+        if init_checkpoint is None:
+            init_checkpoint = os.path.join(bert_dir, "new_weights", question_type)
+        self.init_checkpoint = init_checkpoint
+
+        modeling = self.runner.modeling
+        tokenization = self.runner.tokenization
+        bert_config = modeling.BertConfig.from_json_file(os.path.join(bert_dir, "config.json"))
+        self.tokenizer = tokenization.FullTokenizer(
+            vocab_file=os.path.join(bert_dir, "vocab.txt"), do_lower_case=do_lower_case
+        )
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.input_ids = tf.placeholder(tf.int32, [None, max_seq_length], name="input_ids")
+            self.input_mask = tf.placeholder(tf.int32, [None, max_seq_length], name="input_mask")
+            self.segment_ids = tf.placeholder(tf.int32, [None, max_seq_length], name="segment_ids")
+            outputs = self.runner.create_model(
+                bert_config=bert_config,
+                is_training=False,
+                input_ids=self.input_ids,
+                input_mask=self.input_mask,
+                segment_ids=self.segment_ids,
+                use_one_hot_embeddings=False,
+            )
+            if question_type == "yesno":
+                self.outputs = {"logits": outputs}
+            else:
+                start_logits, end_logits = outputs
+                self.outputs = {"start_logits": start_logits, "end_logits": end_logits}
+            assignment_map, _ = modeling.get_assignment_map_from_checkpoint(
+                tf.trainable_variables(), init_checkpoint
+            )
+            tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+            self.session = tf.Session(graph=self.graph, config=session_config)
+            self.session.run(tf.global_variables_initializer())
+        # export_saved_model adds its save ops to the graph, so it needs an engine built with finalize=False
+        if finalize:
+            self.graph.finalize()
+        print(f"{MAGENTA}Loaded {question_type} QA model from {init_checkpoint} in {time.perf_counter() - start:.1f}s{OFF}")
+
+    # Convert the examples to features, run them through the model in batches and return the runner's RawResults
+    def run(self, examples):
+        features = convert_examples(self.runner, examples, self.tokenizer, self.max_seq_length, self.doc_stride,
+                                    self.max_query_length)
+        results = []
+        for i in range(0, len(features), self.predict_batch_size):
+            batch = features[i:i + self.predict_batch_size]
+            outputs = self.forward(batch)
+            for j, feature in enumerate(batch):
+                results.append(raw_result(self.runner, self.question_type, feature, outputs, j))
+        return features, results
+
+    # The model's logits for a batch of features, keyed by the runner's output names
+    def forward(self, batch):
+        return self.session.run(self.outputs, feed_dict={
+            self.input_ids: [feature.input_ids for feature in batch],
+            self.input_mask: [feature.input_mask for feature in batch],
+            self.segment_ids: [feature.segment_ids for feature in batch],
+        })
+
+    # Answer the questions in json_data (the SQuAD style json of question_answering.get_json_from_data).
+    # predictions.json and nbest_predictions.json are written to output_dir like the runner scripts do, or to a
+    # temporary folder when output_dir is None. Returns (predictions, nbest), nbest is None for yesno questions.
+    def predict(self, json_data, output_dir=None):
+        start = time.perf_counter()
+        examples = read_examples(self.runner, self.question_type, json_data)
+        features, results = self.run(examples)
+        predictions, nbest = write_outputs(
+            self.runner, self.question_type, examples, features, results, self.n_best_size, self.max_answer_length,
+            self.do_lower_case, output_dir,
+        )
+        print(f"{MAGENTA}Answered {len(examples)} {self.question_type} questions in {time.perf_counter() - start:.2f}s{OFF}")
+        return predictions, nbest
+
+    # Bytes held by the model's variables
+    def parameter_bytes(self):
+        return parameter_bytes(self.graph)
+
+    def close(self):
+        self.session.close()
+
+
+# A session config that caps the threads of one engine, so engines answering concurrently share the cores
+# instead of each starting a thread per core. 0 leaves the choice to TensorFlow.
+def thread_config(intra_op_threads=0, inter_op_threads=0):
+    import tensorflow as tf
+    return tf.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads
+    )
+
+
+# Load an engine per question type, returns a dict keyed by question type
+def load_engines(question_types=QUESTION_TYPES, **kwargs):
+    return {question_type: QAEngine(question_type, **kwargs) for question_type in question_types}
+
+
+# Export a question type's fine-tuned checkpoint as a SavedModel in export_dir with a serving signature taking
+# input_ids, input_mask and segment_ids. vocab.txt and config.json are copied next to it, so the folder is all
+# SavedModelPredictor needs.
+def export_saved_model(question_type, export_dir, bert_dir=BERT_MODELS_DIR, init_checkpoint=None, max_seq_length=384):
+    import shutil
+    import tensorflow as tf
+    engine = QAEngine(question_type, bert_dir, init_checkpoint, max_seq_length=max_seq_length, finalize=False)
+    with engine.graph.as_default():
+        tf.saved_model.simple_save(
+            engine.session,
+            export_dir,
+            inputs={"input_ids": engine.input_ids, "input_mask": engine.input_mask, "segment_ids": engine.segment_ids},
+            outputs=engine.outputs,
+        )
+    engine.close()
+    for name in ("vocab.txt", "config.json"):
+        shutil.copy(os.path.join(bert_dir, name), os.path.join(export_dir, name))
+    print(f"{MAGENTA}Exported the {question_type} QA model to {export_dir}{OFF}")
+
+
+# A QAEngine served from a SavedModel written by export_saved_model: loading it restores the serving graph and
+# its variables in one step, without building the runner's model or the Estimator, and the session stays open
+# across predict calls. The runner is still used to turn the questions into features and the logits into answers.
+class SavedModelPredictor(QAEngine):
+
+    def __init__(self, question_type, export_dir, max_seq_length=384, doc_stride=128, max_query_length=64,
+                 predict_batch_size=8, n_best_size=20, max_answer_length=30, do_lower_case=True, session_config=None):
+        import tensorflow as tf
+        start = time.perf_counter()
+        self.question_type = question_type
+        self.runner = import_runner(question_type)
+        init_options(self, max_seq_length, doc_stride, max_query_length, predict_batch_size, n_best_size,
+                     max_answer_length, do_lower_case)
+        self.init_checkpoint = export_dir
+        self.tokenizer = self.runner.tokenization.FullTokenizer(
+            vocab_file=os.path.join(export_dir, "vocab.txt"), do_lower_case=do_lower_case
+        )
+
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        meta_graph = tf.saved_model.loader.load(self.session, [tf.saved_model.tag_constants.SERVING], export_dir)
+        signature = meta_graph.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        self.input_ids = self.graph.get_tensor_by_name(signature.inputs["input_ids"].name)
+        self.input_mask = self.graph.get_tensor_by_name(signature.inputs["input_mask"].name)
+        self.segment_ids = self.graph.get_tensor_by_name(signature.inputs["segment_ids"].name)
+        self.outputs = {name: self.graph.get_tensor_by_name(info.name) for name, info in signature.outputs.items()}
+        self.graph.finalize()
+        print(f"{MAGENTA}Loaded {question_type} QA SavedModel from {export_dir} in {time.perf_counter() - start:.1f}s{OFF}")
+
+
+# Load a SavedModelPredictor per question type from export_root/<question type>, returns a dict keyed by question type
+def load_saved_models(export_root, question_types=QUESTION_TYPES, **kwargs):
+    return {
+        question_type: SavedModelPredictor(question_type, os.path.join(export_root, question_type), **kwargs)
+        for question_type in question_types
+    }
+
+
+# The factoid/list span head of run_factoid.py / run_list.py's create_model, under scope
+def span_head(modeling, final_hidden, scope):
+    import tensorflow as tf
+    batch_size, seq_length, hidden_size = modeling.get_shape_list(final_hidden, expected_rank=3)
+    with tf.variable_scope(scope):
+        output_weights = tf.get_variable(
+            "cls/squad/output_weights", [2, hidden_size], initializer=tf.truncated_normal_initializer(stddev=0.02)
+        )
+        output_bias = tf.get_variable("cls/squad/output_bias", [2], initializer=tf.zeros_initializer())
+    logits = tf.matmul(tf.reshape(final_hidden, [batch_size * seq_length, hidden_size]), output_weights, transpose_b=True)
+    logits = tf.nn.bias_add(logits, output_bias)
+    logits = tf.transpose(tf.reshape(logits, [batch_size, seq_length, 2]), [2, 0, 1])
+    start_logits, end_logits = tf.unstack(logits, axis=0)
+    return {"start_logits": start_logits, "end_logits": end_logits}, {
+        "cls/squad/output_weights": output_weights, "cls/squad/output_bias": output_bias
+    }
+
+
+# The yesno sigmoid head of run_yesno.py's create_model on the first ([CLS]) token, under scope
+def yesno_head(modeling, final_hidden, scope):
+    import tensorflow as tf
+    hidden_size = modeling.get_shape_list(final_hidden, expected_rank=3)[2]
+    with tf.variable_scope(scope):
+        output_weights = tf.get_variable(
+            "cls/squad/output_weights_sgm", [1, hidden_size], initializer=tf.truncated_normal_initializer(stddev=0.02)
+        )
+        output_bias = tf.get_variable("cls/squad/output_bias_sgm", [1], initializer=tf.zeros_initializer())
+    logits = tf.nn.bias_add(tf.matmul(final_hidden[:, 0, :], output_weights, transpose_b=True), output_bias)
+    return {"logits": logits}, {
+        "cls/squad/output_weights_sgm": output_weights, "cls/squad/output_bias_sgm": output_bias
+    }
+
+
+# One BioBERT encoder shared by the factoid, list and yesno heads.
+# The encoder is restored from encoder_checkpoint (the factoid model's by default) and each head from its own
+# question type's checkpoint, or everything at once from a checkpoint written by export_merged. A batch of
+# features of any mix of types goes through the encoder once and every head reads the same hidden states, so a
+# mixed batch costs one encoder pass per feature and one model in memory instead of three.
+# The factoid, list and yesno models were fine-tuned separately, so answers can differ slightly from QAEngine's.
+class MultiHeadQAEngine:
+
+    def __init__(self, bert_dir=BERT_MODELS_DIR, encoder_checkpoint=None, head_checkpoints=None,
+                 merged_checkpoint=None, question_types=QUESTION_TYPES, max_seq_length=384, doc_stride=128,
+                 max_query_length=64, predict_batch_size=8, n_best_size=20, max_answer_length=30,
+                 do_lower_case=True, session_config=None):
+        import tensorflow as tf
+        start = time.perf_counter()
+        self.question_types = tuple(question_types)
+        self.runners = {question_type: import_runner(question_type) for question_type in self.question_types}
+        init_options(self, max_seq_length, doc_stride, max_query_length, predict_batch_size, n_best_size,
+                     max_answer_length, do_lower_case)
+        if encoder_checkpoint is None:
+            encoder_checkpoint = os.path.join(bert_dir, "new_weights", self.question_types[0])
+        head_checkpoints = dict(head_checkpoints or {})
+        for question_type in self.question_types:
+            head_checkpoints.setdefault(question_type, os.path.join(bert_dir, "new_weights", question_type))
+
+        # every runner imports the same modeling and tokenization modules
+        runner = self.runners[self.question_types[0]]
+        modeling = runner.modeling
+        bert_config = modeling.BertConfig.from_json_file(os.path.join(bert_dir, "config.json"))
+        self.tokenizer = runner.tokenization.FullTokenizer(
+            vocab_file=os.path.join(bert_dir, "vocab.txt"), do_lower_case=do_lower_case
+        )
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.input_ids = tf.placeholder(tf.int32, [None, max_seq_length], name="input_ids")
+            self.input_mask = tf.placeholder(tf.int32, [None, max_seq_length], name="input_mask")
+            self.segment_ids = tf.placeholder(tf.int32, [None, max_seq_length], name="segment_ids")
+            encoder = modeling.BertModel(
+                config=bert_config,
+                is_training=False,
+                input_ids=self.input_ids,
+                input_mask=self.input_mask,
+                token_type_ids=self.segment_ids,
+                use_one_hot_embeddings=False,
+            )
+            final_hidden = encoder.get_sequence_output()
+            self.outputs = {}
+            head_variables = {}
+            for question_type in self.question_types:
+                head = yesno_head if question_type == "yesno" else span_head
+                self.outputs[question_type], head_variables[question_type] = head(modeling, final_hidden, question_type)
+            self.saver = tf.train.Saver()
+            if merged_checkpoint is None:
+                tf.train.init_from_checkpoint(encoder_checkpoint, {"bert/": "bert/"})
+                for question_type, variables in head_variables.items():
+                    # the heads live under their question type's scope here, and at the top level in their checkpoint
+                    tf.train.init_from_checkpoint(head_checkpoints[question_type], variables)
+            self.session = tf.Session(graph=self.graph, config=session_config)
+            if merged_checkpoint is None:
+                self.session.run(tf.global_variables_initializer())
+            else:
+                self.saver.restore(self.session, merged_checkpoint)
+        self.graph.finalize()
+        source = merged_checkpoint or encoder_checkpoint
+        print(f"{MAGENTA}Loaded the {', '.join(self.question_types)} QA heads on one encoder from {source} "
+              f"in {time.perf_counter() - start:.1f}s{OFF}")
+
+    # Answer the questions of several types at once. json_by_type maps question types to SQuAD style json,
+    # output_dirs maps them to the folders their prediction files are written to (temporary ones by default).
+    # Returns a dict of question type -> (predictions, nbest)
+    def predict(self, json_by_type, output_dirs=None):
+        start = time.perf_counter()
+        output_dirs = output_dirs or {}
+        examples, features = {}, {}
+        # (question type, feature) pairs of every type, batched together
+        jobs = []
+        for question_type, json_data in json_by_type.items():
+            runner = self.runners[question_type]
+            examples[question_type] = read_examples(runner, question_type, json_data)
+            features[question_type] = convert_examples(
+                runner, examples[question_type], self.tokenizer, self.max_seq_length, self.doc_stride,
+                self.max_query_length,
+            )
+            jobs.extend((question_type, feature) for feature in features[question_type])
+        fetches = {question_type: self.outputs[question_type] for question_type in json_by_type}
+        results = {question_type: [] for question_type in json_by_type}
+        for i in range(0, len(jobs), self.predict_batch_size):
+            batch = jobs[i:i + self.predict_batch_size]
+            outputs = self.session.run(fetches, feed_dict={
+                self.input_ids: [feature.input_ids for _, feature in batch],
+                self.input_mask: [feature.input_mask for _, feature in batch],
+                self.segment_ids: [feature.segment_ids for _, feature in batch],
+            })
+            for j, (question_type, feature) in enumerate(batch):
+                results[question_type].append(
+                    raw_result(self.runners[question_type], question_type, feature, outputs[question_type], j)
+                )
+        answers = {}
+        for question_type in json_by_type:
+            answers[question_type] = write_outputs(
+                self.runners[question_type], question_type, examples[question_type], features[question_type],
+                results[question_type], self.n_best_size, self.max_answer_length, self.do_lower_case,
+                output_dirs.get(question_type),
+            )
+        print(f"{MAGENTA}Answered {sum(len(e) for e in examples.values())} questions ({len(jobs)} features) "
+              f"in {time.perf_counter() - start:.2f}s{OFF}")
+        return answers
+
+    # Drop-in engines for question_answering.get_answer and run_batch_mode, keyed by question type
+    def heads(self):
+        return {question_type: QAHead(self, question_type) for question_type in self.question_types}
+
+    # Save the encoder and all heads to one checkpoint, which later loads restore in a single step
+    def export_merged(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        saved = self.saver.save(self.session, path)
+        print(f"{MAGENTA}Saved the merged QA checkpoint to {saved}{OFF}")
+        return saved
+
+    def parameter_bytes(self):
+        return parameter_bytes(self.graph)
+
+    def close(self):
+        self.session.close()
+
+
+# One question type of a MultiHeadQAEngine, with the predict interface of QAEngine
+class QAHead:
+
+    def __init__(self, engine, question_type):
+        self.engine = engine
+        self.question_type = question_type
+
+    def predict(self, json_data, output_dir=None):
+        return self.engine.predict({self.question_type: json_data}, {self.question_type: output_dir})[self.question_type]
+
+
+# Answer the batch mode QA inputs under input_dir with three QAEngines and then with one MultiHeadQAEngine,
+# printing the load time, variable memory and answering time of each
+def compare(input_dir, bert_dir=BERT_MODELS_DIR, merged_checkpoint=None):
+    json_by_type = {}
+    for question_type, file_name in INPUT_FILES.items():
+        path = os.path.join(input_dir, question_type, file_name)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                json_by_type[question_type] = json.load(f)
+    start = time.perf_counter()
+    engines = load_engines(bert_dir=bert_dir)
+    separate_load = time.perf_counter() - start
+    separate_bytes = sum(engine.parameter_bytes() for engine in engines.values())
+    start = time.perf_counter()
+    for question_type, json_data in json_by_type.items():
+        engines[question_type].predict(json_data)
+    separate_predict = time.perf_counter() - start
+    for engine in engines.values():
+        engine.close()
+
+    start = time.perf_counter()
+    engine = MultiHeadQAEngine(bert_dir=bert_dir, merged_checkpoint=merged_checkpoint)
+    shared_load = time.perf_counter() - start
+    shared_bytes = engine.parameter_bytes()
+    start = time.perf_counter()
+    engine.predict(json_by_type)
+    shared_predict = time.perf_counter() - start
+    engine.close()
+    print(f"{MAGENTA}Separate engines: loaded in {separate_load:.1f}s, {separate_bytes / 2**20:.0f} MiB of variables, "
+          f"answered in {separate_predict:.2f}s{OFF}")
+    print(f"{MAGENTA}Shared encoder:   loaded in {shared_load:.1f}s, {shared_bytes / 2**20:.0f} MiB of variables, "
+          f"answered in {shared_predict:.2f}s{OFF}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_dir", default=BERT_MODELS_DIR, help="Folder holding config.json, vocab.txt and new_weights/")
+    parser.add_argument("--export_merged", help="Write the shared encoder and the three heads to this checkpoint path")
+    parser.add_argument("--merged_checkpoint", help="Load the shared encoder model from this merged checkpoint")
+    parser.add_argument("--export_saved_model", metavar="EXPORT_ROOT",
+                        help="Export every question type's checkpoint as a SavedModel under EXPORT_ROOT/<question type>")
+    parser.add_argument("--compare", metavar="INPUT_DIR",
+                        help="Compare separate and shared encoder models on the batch mode QA inputs in INPUT_DIR (e.g. tmp/qa/)")
+    args = parser.parse_args()
+    if args.export_merged:
+        multi_head = MultiHeadQAEngine(bert_dir=args.bert_dir, merged_checkpoint=args.merged_checkpoint)
+        multi_head.export_merged(args.export_merged)
+        multi_head.close()
+    if args.export_saved_model:
+        for question_type in QUESTION_TYPES:
+            export_saved_model(question_type, os.path.join(args.export_saved_model, question_type), args.bert_dir)
+    if args.compare:
+        compare(args.compare, args.bert_dir, args.merged_checkpoint)
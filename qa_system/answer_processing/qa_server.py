@@ -0,0 +1,243 @@
+"""
+qa_server.py keeps the factoid, list and yesno BioBERT models resident in one long-running local service, so
+several qa_system.py sessions on a host share one copy of the models instead of each loading all three.
+
+Start it from the qa_system folder:
+    python -m answer_processing.qa_server --port 8765
+and point qa_system.py at it with --qa_backend server --qa_server_url http://127.0.0.1:8765
+
+Requests of the same question type that arrive within --max_wait_ms of each other are answered together in one
+micro-batch. Every response carries its timing in the X-Queue-Ms, X-Inference-Ms and X-Batch-Size headers.
+"""
+from utils import *
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import answer_processing.qa_engine as qa_engine
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 10
+
+
+class PendingRequest:
+
+    def __init__(self, json_data):
+        self.json_data = json_data
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.predictions = None
+        self.nbest = None
+        self.error = None
+        self.queue_ms = 0.0
+        self.inference_ms = 0.0
+        self.batch_size = 0
+
+
+# Collects the requests for one engine and answers them in micro-batches: a batch is run as soon as it holds
+# max_batch_size requests or max_wait_ms after its first request arrived (or after the worker got to it, when it
+# queued behind a running batch), whichever comes first
+class MicroBatcher:
+
+    def __init__(self, engine, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, name=f"{engine.question_type}-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, json_data):
+        request = PendingRequest(json_data)
+        self.requests.put(request)
+        request.done.wait()
+        return request
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            # take what queued up while the last batch ran without waiting
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            # a request that already waited out max_wait in the queue still gets max_wait for others to join,
+            # otherwise every batch under load would be cut at its first request
+            deadline = max(batch[0].received + self.max_wait, time.perf_counter())
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.answer(batch)
+
+    # Merge the batch into one input, tagging every question id with its request so the answers can be split back
+    # Every request's done is set whatever goes wrong, so no submitter is left waiting and the worker keeps running
+    def answer(self, batch):
+        start = time.perf_counter()
+        try:
+            merged = {"data": []}
+            for r, request in enumerate(batch):
+                for entry in request.json_data["data"]:
+                    paragraphs = []
+                    for paragraph in entry["paragraphs"]:
+                        qas = [dict(qa, id=f"{r}:{qa['id']}") for qa in paragraph["qas"]]
+                        paragraphs.append(dict(paragraph, qas=qas))
+                    merged["data"].append(dict(entry, paragraphs=paragraphs))
+            predictions, nbest = self.engine.predict(merged)
+            for r, request in enumerate(batch):
+                request.predictions = split_by_request(predictions, r)
+                request.nbest = split_by_request(nbest, r) if nbest is not None else None
+        except Exception as e:
+            for request in batch:
+                request.error = repr(e)
+        finally:
+            inference_ms = 1000 * (time.perf_counter() - start)
+            for request in batch:
+                request.queue_ms = 1000 * (start - request.received)
+                request.inference_ms = inference_ms
+                request.batch_size = len(batch)
+                request.done.set()
+
+
+# The error in json_data's shape, None when it is the SQuAD style input the engines take
+def payload_error(json_data):
+    if not isinstance(json_data, dict) or not isinstance(json_data.get("data"), list):
+        return "expected an object with a \"data\" list"
+    for entry in json_data["data"]:
+        if not isinstance(entry, dict) or not isinstance(entry.get("paragraphs"), list):
+            return "every data entry needs a \"paragraphs\" list"
+        for paragraph in entry["paragraphs"]:
+            if not isinstance(paragraph, dict) or not isinstance(paragraph.get("context"), str) \
+                    or not isinstance(paragraph.get("qas"), list):
+                return "every paragraph needs a \"context\" string and a \"qas\" list"
+            for qa in paragraph["qas"]:
+                if not isinstance(qa, dict) or "id" not in qa or not isinstance(qa.get("question"), str):
+                    return "every qas entry needs an \"id\" and a \"question\" string"
+    return None
+
+# The answers of request r, under their original question ids
+def split_by_request(results, r):
+    prefix = f"{r}:"
+    return {key[len(prefix):]: value for key, value in results.items() if key.startswith(prefix)}
+
+
+class QARequestHandler(BaseHTTPRequestHandler):
+    # set on the handler class by serve()
+    batchers = {}
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"question_types": sorted(self.batchers)})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    # POST /predict/<question type> with the SQuAD style json of question_answering.get_json_from_data
+    def do_POST(self):
+        question_type = self.path.rstrip("/").split("/")[-1]
+        if not self.path.startswith("/predict/") or question_type not in self.batchers:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            json_data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as e:
+            self.send_json(400, {"error": f"invalid json: {e}"})
+            return
+        error = payload_error(json_data)
+        if error is not None:
+            self.send_json(400, {"error": f"invalid input: {error}"})
+            return
+        request = self.batchers[question_type].submit(json_data)
+        headers = {
+            "X-Queue-Ms": f"{request.queue_ms:.1f}",
+            "X-Inference-Ms": f"{request.inference_ms:.1f}",
+            "X-Batch-Size": str(request.batch_size),
+        }
+        if request.error is not None:
+            self.send_json(500, {"error": request.error}, headers)
+        else:
+            self.send_json(200, {"predictions": request.predictions, "nbest": request.nbest}, headers)
+
+    def log_message(self, format, *args):
+        print(f"{WHITE}{self.address_string()} {format % args}{OFF}")
+
+
+def serve(engines, host=DEFAULT_HOST, port=DEFAULT_PORT, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+    QARequestHandler.batchers = {
+        question_type: MicroBatcher(engine, max_batch_size, max_wait_ms) for question_type, engine in engines.items()
+    }
+    server = ThreadingHTTPServer((host, port), QARequestHandler)
+    print(f"{MAGENTA}Serving {', '.join(sorted(engines))} QA on http://{host}:{port}{OFF}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# Client for the service with the same predict interface as qa_engine.QAEngine, so it is a drop-in engine
+# for question_answering.get_answer and run_batch_mode
+class RemoteQAEngine:
+
+    def __init__(self, question_type, url=DEFAULT_URL, timeout=600):
+        self.question_type = question_type
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def predict(self, json_data, output_dir=None):
+        request = urllib.request.Request(
+            f"{self.url}/predict/{self.question_type}",
+            data=json.dumps(json_data).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = json.loads(response.read())
+            print(f"{MAGENTA}QA server answered {self.question_type} in {response.headers.get('X-Inference-Ms')} ms "
+                  f"(queued {response.headers.get('X-Queue-Ms')} ms, batch of {response.headers.get('X-Batch-Size')}){OFF}")
+        predictions, nbest = body["predictions"], body["nbest"]
+        # write the same files the runners write, the batch mode BioASQ transform reads them
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(os.path.join(output_dir, "predictions.json"), "w") as f:
+                f.write(json.dumps(predictions, indent=4) + "\n")
+            if nbest is not None:
+                with open(os.path.join(output_dir, "nbest_predictions.json"), "w") as f:
+                    f.write(json.dumps(nbest, indent=4) + "\n")
+        return predictions, nbest
+
+
+def remote_engines(url=DEFAULT_URL, question_types=qa_engine.QUESTION_TYPES):
+    return {question_type: RemoteQAEngine(question_type, url) for question_type in question_types}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on, localhost only by default")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--max_batch_size", type=int, default=MAX_BATCH_SIZE,
+                        help="Maximum number of requests answered together in one micro-batch")
+    parser.add_argument("--max_wait_ms", type=float, default=MAX_WAIT_MS,
+                        help="Maximum time a request waits for others to join its micro-batch")
+    args = parser.parse_args()
+    serve(qa_engine.load_engines(), args.host, args.port, args.max_batch_size, args.max_wait_ms)
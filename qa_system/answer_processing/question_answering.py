@@ -23,23 +23,185 @@ import warnings
 warnings.filterwarnings('ignore')
 
 from utils import *
+import collections
 import json
 from json import loads
 import os
+import subprocess
+import sys
 import time
-from bs4 import BeautifulSoup as bs
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree as ET
+
+# How a QA run ended: status is "ok", "failed", "timeout" or "skipped", outputs maps "predictions" / "nbest" to the
+# files the run wrote and error holds the tail of the runner's stderr log when it did not succeed
+QARunResult = collections.namedtuple(
+    "QARunResult", ["question_type", "status", "returncode", "outputs", "elapsed", "error"]
+)
+# Seconds a live mode runner script gets before it is killed, batch mode runs have no limit unless --qa_timeout sets one
+QA_TIMEOUT = 1800
+# Number of question types answered at the same time in batch mode, 1 runs them one after the other
+QA_JOBS = 3
+
+# Intra-op threads each concurrent QA job gets: threads if it is set, otherwise an even share of the cores
+def qa_thread_budget(jobs=QA_JOBS, threads=0):
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // max(1, jobs))
+
+# Number of retrieved abstracts (passages) a question is answered over
+QA_PASSAGES = 5
+# A question asked over several passages gets one qas id per passage, <question id><PASSAGE_SEPARATOR><rank>
+PASSAGE_SEPARATOR = "_p"
+
+def passage_id(id, rank):
+    return f"{id}{PASSAGE_SEPARATOR}{rank}"
+
+# Split a qas id into its question id and passage rank, ids without a passage suffix are rank 0
+def split_passage_id(qas_id):
+    question_id, separator, rank = str(qas_id).rpartition(PASSAGE_SEPARATOR)
+    if separator and rank.isdigit():
+        return question_id, int(rank)
+    return str(qas_id), 0
+
+# Answers from higher ranked passages count for more
+def rank_weight(rank):
+    return 1 / (rank + 1)
+
+# Merge the per-passage answers of every question into one answer per question id.
+# Factoid and list candidates with the same text are pooled, each scoring its span probability times the
+# rank weight of its passage, and the pooled nbest is renormalized. The yesno logits are averaged with the
+# rank weights and answered 'yes' above 0.5, like run_yesno.py does. Returns (predictions, nbest).
+def aggregate_passages(question_type, predictions, nbest=None):
+    if not any(split_passage_id(qas_id)[0] != str(qas_id) for qas_id in predictions):
+        return predictions, nbest
+    if question_type == "yesno":
+        pooled = collections.OrderedDict()
+        for qas_id, (_, logits) in predictions.items():
+            question_id, rank = split_passage_id(qas_id)
+            weights, totals = pooled.setdefault(question_id, ([], [0.0] * len(logits)))
+            weights.append(rank_weight(rank))
+            for i, logit in enumerate(logits):
+                totals[i] += rank_weight(rank) * logit
+        merged = collections.OrderedDict()
+        for question_id, (weights, totals) in pooled.items():
+            logits = [total / sum(weights) for total in totals]
+            merged[question_id] = ['yes' if logits[0] > 0.5 else 'no', logits]
+        return merged, None
+    pooled = collections.OrderedDict()
+    sizes = {}
+    for qas_id, entries in nbest.items():
+        question_id, rank = split_passage_id(qas_id)
+        candidates = pooled.setdefault(question_id, collections.OrderedDict())
+        sizes[question_id] = max(sizes.get(question_id, 0), len(entries))
+        for entry in entries:
+            score = rank_weight(rank) * entry["probability"]
+            key = " ".join(entry["text"].lower().split())
+            candidate = candidates.get(key)
+            if candidate is None:
+                candidates[key] = dict(entry, score=score, best=score)
+            else:
+                candidate["score"] += score
+                # keep the text and logits of the candidate's best scoring span
+                if score > candidate["best"]:
+                    candidate.update(entry, best=score)
+    merged_predictions = collections.OrderedDict()
+    merged_nbest = collections.OrderedDict()
+    for question_id, candidates in pooled.items():
+        ranked = sorted(candidates.values(), key=lambda candidate: candidate["score"], reverse=True)[:sizes[question_id]]
+        total = sum(candidate["score"] for candidate in ranked) or 1.0
+        merged_nbest[question_id] = [
+            {"text": candidate["text"], "probability": candidate["score"] / total,
+             "start_logit": candidate.get("start_logit"), "end_logit": candidate.get("end_logit")}
+            for candidate in ranked
+        ]
+        merged_predictions[question_id] = ranked[0]["text"] if ranked else ""
+    return merged_predictions, merged_nbest
+
+# Aggregate the per-passage predictions.json (and nbest_predictions.json) a QA run wrote to output_dir in place
+# Returns (predictions, nbest), nbest is None for yesno questions
+def merge_passage_outputs(output_dir, question_type):
+    outputs = qa_outputs(output_dir)
+    with open(outputs["predictions"], "r") as f:
+        predictions = json.load(f)
+    nbest = None
+    if question_type != "yesno" and "nbest" in outputs:
+        with open(outputs["nbest"], "r") as f:
+            nbest = json.load(f)
+    if question_type != "yesno" and nbest is None:
+        return predictions, nbest
+    merged_predictions, merged_nbest = aggregate_passages(question_type, predictions, nbest)
+    if merged_predictions is not predictions:
+        print_json_to_file(outputs["predictions"], merged_predictions)
+        if merged_nbest is not None:
+            print_json_to_file(outputs["nbest"], merged_nbest)
+    return merged_predictions, merged_nbest
+
+# the files a QA run and transform_to_bioasq write to a question type's output folder
+QA_OUTPUT_FILES = ("predictions.json", "nbest_predictions.json", "null_odds.json", "BioASQform_BioASQ-answer.json")
+
+# Remove the outputs an earlier run left in output_dir, so a type that is skipped, fails or times out has no
+# stale answers for transform_to_bioasq to pick up
+def remove_qa_outputs(output_dir):
+    for file_name in QA_OUTPUT_FILES:
+        path = os.path.join(output_dir, file_name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+# the runner script's stderr (TensorFlow's progress and errors) goes to this file in its output folder
+RUNNER_LOG_NAME = "runner_stderr.log"
+
+# The last size characters of the text file at path
+def log_tail(path, size=2000):
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - size))
+        return f.read().decode("utf-8", "replace")
+
+def qa_outputs(output_dir):
+    outputs = {}
+    for name, file_name in (("predictions", "predictions.json"), ("nbest", "nbest_predictions.json")):
+        path = os.path.join(output_dir, file_name)
+        if os.path.isfile(path):
+            outputs[name] = path
+    return outputs
 
 # pass formatted json into file that generates answer
-def run_qa_file(filename, output_dir,predict_file, question_type):
+# waits for the runner to exit (or kills it after timeout seconds) and returns a QARunResult
+# the runner's stderr is written to output_dir/RUNNER_LOG_NAME, follow it with tail -f while the runner works
+# threads caps the runner's TensorFlow intra-op threads (and its inter-op threads to 1), 0 leaves them to TensorFlow
+def run_qa_file(filename, output_dir,predict_file, question_type, timeout=QA_TIMEOUT, threads=0):
     print(f"{MAGENTA}Running {filename}{OFF}")
     # if list/factoid run 1, else run biobert 2
 
     vocab_file_path = f'bert_models/vocab.txt'
     bert_config_file = f'bert_models/config.json'
     checkpoint_folder = f'bert_models/new_weights/{question_type}'
-    command = f"python {filename} --do_train=False --do_predict=True --vocab_file={vocab_file_path} --bert_config_file={bert_config_file} --init_checkpoint={checkpoint_folder} --output_dir={output_dir} --predict_file={predict_file}"
-    print(f"{MAGENTA}Running command: {command}{OFF}")
-    os.system(command)
+    command = [sys.executable, filename, "--do_train=False", "--do_predict=True", f"--vocab_file={vocab_file_path}",
+               f"--bert_config_file={bert_config_file}", f"--init_checkpoint={checkpoint_folder}",
+               f"--output_dir={output_dir}", f"--predict_file={predict_file}"]
+    env = None
+    if threads > 0:
+        command += [f"--intra_op_threads={threads}", "--inter_op_threads=1"]
+        # the math libraries under TensorFlow size their own thread pools from these
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    os.makedirs(output_dir, exist_ok=True)
+    log_path = os.path.join(output_dir, RUNNER_LOG_NAME)
+    print(f"{MAGENTA}Running command: {' '.join(command)}, logging to {log_path}{OFF}")
+    start = time.perf_counter()
+    try:
+        with open(log_path, "wb") as log:
+            process = subprocess.run(command, stderr=log, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        print(f"{RED}{filename} did not finish within {timeout}s, see {log_path}{OFF}")
+        return QARunResult(
+            question_type, "timeout", None, qa_outputs(output_dir), time.perf_counter() - start, log_tail(log_path)
+        )
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        error = log_tail(log_path)
+        print(f"{RED}{filename} failed with exit code {process.returncode}, see {log_path}:\n{error}{OFF}")
+        return QARunResult(question_type, "failed", process.returncode, qa_outputs(output_dir), elapsed, error)
+    return QARunResult(question_type, "ok", 0, qa_outputs(output_dir), elapsed, None)
 
 # prints json to file ;)
 def print_json_to_file(file, json_data, batch_mode = False):
@@ -60,13 +222,20 @@ def print_json_to_file(file, json_data, batch_mode = False):
         outfile.close()
 
 # This is all to get the data in the proper format for the json file
+# abstract is either one abstract or the list of retrieved abstracts in rank order, a list gets a paragraph
+# per abstract and each paragraph's question a passage id so the runner answers them all in one run
 def get_json_from_data(data):
     id, type, question, abstract = data
     json_data = {}
-    qas = [{'id':id, 'question':question}]
-    one_item = {'qas':qas,'context':abstract}
     paragraphs = []
-    paragraphs.append(one_item)
+    if isinstance(abstract, (list, tuple)):
+        for rank, passage in enumerate(abstract):
+            if passage:
+                paragraphs.append({'qas':[{'id':passage_id(id, rank), 'question':question}],'context':passage})
+    else:
+        qas = [{'id':id, 'question':question}]
+        one_item = {'qas':qas,'context':abstract}
+        paragraphs.append(one_item)
     json_data['data'] = [{'paragraphs':paragraphs}]
     return json_data
 
@@ -109,8 +278,16 @@ def setup_file_system(output_dir,batch_mode = False):
             os.mkdir (list_path)
     return inputfile_path, outfile_path, factoid_path,yesno_path,list_path
 
-def get_answer(json_data, output_dir, batch_mode = False):
+# engines maps question types to in-process qa_engine.QAEngine models, questions of those types are answered
+# in-process and the other types still run their runner script
+# In batch mode with batch_inputs (a dict of per-type SQuAD style json) the question is only added to its type's
+# json in memory, the caller writes each type's file once when every question has been added
+def get_answer(json_data, output_dir, batch_mode = False, engines=None, batch_inputs=None):
     q_id, q_type, question,abstract = json_data
+    if batch_mode and batch_inputs is not None:
+        if q_type in batch_inputs: # We don't handle the summary case
+            batch_inputs[q_type]['data'].extend(get_json_from_data(json_data)['data'])
+        return
     inputfile_path,outfile_path,factoid_path,yesno_path,list_path = setup_file_system(output_dir)
     # list nbest is used to respond with multiple results
     if(batch_mode):
@@ -126,6 +303,18 @@ def get_answer(json_data, output_dir, batch_mode = False):
             print_json_to_file(list_file_path, printing_json, batch_mode=True)
         else: # We don't handle the summary case
             return 
+    elif engines and q_type in engines:
+        print(f'{MAGENTA}Question answering json: {json_data}{OFF} ')
+        print(f"{MAGENTA}Question type <{q_type}>{OFF}")
+        try:
+            engines[q_type].predict(get_json_from_data(json_data), output_dir)
+        except Exception as e:
+            # like a failed runner script, None tells the caller the question was not answered
+            print(f"{RED}{q_type} QA failed: {e!r}{OFF}")
+            return None
+        predictions, nbest = merge_passage_outputs(output_dir, q_type)
+        # allow for getting multiple predictions for list questions
+        return nbest if q_type == 'list' else predictions
     else:
         print(f'{MAGENTA}Question answering json: {json_data}{OFF} ')
         # Write data in BioASQ format to json file
@@ -133,74 +322,139 @@ def get_answer(json_data, output_dir, batch_mode = False):
         print_json_to_file(inputfile_path, good_json_data)
         print(f"{MAGENTA}Question type <{q_type}>{OFF}")
         if q_type == 'yesno':
-            run_qa_file('run_yesno.py',output_dir, predict_file=inputfile_path,question_type=q_type)
+            run_result = run_qa_file('run_yesno.py',output_dir, predict_file=inputfile_path,question_type=q_type)
         elif q_type == 'factoid':
-            run_qa_file('run_factoid.py',output_dir, predict_file=inputfile_path,question_type=q_type)
+            run_result = run_qa_file('run_factoid.py',output_dir, predict_file=inputfile_path,question_type=q_type)
         elif q_type == 'list':
-            run_qa_file('run_list.py',output_dir, predict_file=inputfile_path,question_type=q_type)
-            list_nbest = output_dir + "nbest_predictions.json"
-            # allow for getting multiple predictions
-            outfile_path = list_nbest
+            run_result = run_qa_file('run_list.py',output_dir, predict_file=inputfile_path,question_type=q_type)
         else: # We don't handle the summary case
             return 
-        while (not os.path.exists(outfile_path)):
-            time.sleep(1)
-        # Wait for qa script to finish to respond with answer if not batch mode
-        if os.path.isfile(outfile_path):
-            with open(outfile_path,'r') as j:
-                results = json.loads(j.read()) 
-                j.close()
-                return results
-
-def run_batch_mode(input_file,output_dir):
+        # the runner has exited, a failed run returns None so the caller reports the error
+        if run_result.status != "ok" or "predictions" not in run_result.outputs:
+            return None
+        predictions, nbest = merge_passage_outputs(output_dir, q_type)
+        # allow for getting multiple predictions for list questions
+        return nbest if q_type == 'list' else predictions
+
+# Run a question type's accumulated input file through its in-process engine if there is one, otherwise its runner script
+# The per-passage answers of a successful run are merged into one answer per question.
+# Returns the QARunResult of the run. threads is the runner script's thread budget, in-process engines get theirs
+# when they are loaded (qa_engine.thread_config), timeout the seconds the runner script may run (None for no limit)
+def run_qa_type(engines, question_type, filename, output_dir, predict_file, threads=0, timeout=None):
+    remove_qa_outputs(output_dir)
+    if not os.path.exists(predict_file):
+        print(f"{MAGENTA}No {question_type} questions to answer{OFF}")
+        return QARunResult(question_type, "skipped", None, {}, 0.0, None)
+    if engines and question_type in engines:
+        start = time.perf_counter()
+        try:
+            with open(predict_file, "r") as f:
+                engines[question_type].predict(json.load(f), output_dir)
+        except Exception as e:
+            print(f"{RED}{question_type} QA failed: {e!r}{OFF}")
+            return QARunResult(question_type, "failed", None, qa_outputs(output_dir), time.perf_counter() - start, repr(e))
+        run_result = QARunResult(question_type, "ok", 0, qa_outputs(output_dir), time.perf_counter() - start, None)
+    else:
+        run_result = run_qa_file(
+            filename, output_dir, predict_file=predict_file, question_type=question_type, timeout=timeout, threads=threads
+        )
+    if run_result.status == "ok" and "predictions" in run_result.outputs:
+        merge_passage_outputs(output_dir, question_type)
+    return run_result
+
+# Print how long each QA run took and how much wall clock running them concurrently saved over running them in turn
+def report_qa_timing(run_results, wall_clock):
+    sequential = 0.0
+    for run_result in run_results:
+        if run_result.status != "skipped":
+            print(f"{MAGENTA}{run_result.question_type} QA {run_result.status} in {run_result.elapsed:.1f}s{OFF}")
+            sequential += run_result.elapsed
+    print(f"{MAGENTA}QA took {wall_clock:.1f}s wall clock for {sequential:.1f}s of runs, "
+          f"saving {sequential - wall_clock:.1f}s over running them in turn{OFF}")
+
+# Stream the <Q> elements of an IR output file, yielding (id, type, question, abstracts) per question where abstracts
+# holds the text of its first max_abstracts <Result> abstracts in rank order. Each <Q> is cleared once it has been
+# read, so memory does not grow with the size of the file.
+def iter_ir_output(input_file, max_abstracts=1):
+    for _, q in ET.iterparse(input_file, events=("end",), tag="Q"):
+        qp = q.find("QP")
+        q_type = qp.findtext("Type", default="") if qp is not None else ""
+        abstracts = []
+        ir = q.find("IR")
+        if ir is not None:
+            for result in ir.iterfind("Result"):
+                if len(abstracts) == max_abstracts:
+                    break
+                abstracts.append(result.findtext("Abstract", default=""))
+        yield q.get("id"), q_type, q.text or "", abstracts
+        q.clear(keep_tail=True)
+        # drop the questions already read from the root too
+        while q.getprevious() is not None:
+            del q.getparent()[0]
+
+# qa_jobs question types are answered at the same time, each with a budget of qa_threads threads
+# (qa_thread_budget picks an even share of the cores when qa_threads is 0)
+# Every question is answered over its top passages retrieved abstracts
+# qa_timeout is the seconds each runner script may run before it is killed, None (the default) for no limit
+def run_batch_mode(input_file,output_dir, engines=None, qa_jobs=QA_JOBS, qa_threads=0, passages=QA_PASSAGES,
+                   qa_timeout=None):
     print(f"{MAGENTA}reading {input_file} for input{OFF}")
-    with open(input_file, "rU") as file:
-        content = file.readlines()
-        content = "".join(content)
-        soup = bs(content,"lxml")
-        result = soup.find_all("q") # get all the questions
-        for i, item in enumerate(result):
-            type = item.find("qp").find("type").get_text()
-            id = item.attrs['id']
-            original_question = str(item.find('qp').previousSibling)
-            try:
-                abstract_text = item.find('ir').find('result').find("abstract").get_text()
-            except:
-                # If IR was unsuccessful when it came to retrieving documents for the given question
-                abstract_text = ""
-            data = (id, type, original_question, abstract_text)
-            print(f"{MAGENTA}({i+1}/{len(result)}) Getting answer for \'{original_question}\'{OFF}")
-            # write all questions to a general file
-            # json_data = get_json_from_data(data)
-            # print_json_to_file(output_dir+ "qa_all.json", json_data, batch_mode=True)
-            if abstract_text != "":
-                # get the answers for questions with relevant concepts
-                get_answer(data,output_dir,batch_mode=True)
+    # the QA inputs of every question type are built in memory and written once below
+    batch_inputs = {"yesno": {'data': []}, "factoid": {'data': []}, "list": {'data': []}}
+    start = time.perf_counter()
+    for i, (id, type, original_question, abstracts) in enumerate(iter_ir_output(input_file, max_abstracts=passages)):
+        data = (id, type, original_question, abstracts)
+        print(f"{MAGENTA}({i+1}) Getting answer for \'{original_question}\' over {len(abstracts)} abstracts{OFF}")
+        # write all questions to a general file
+        # json_data = get_json_from_data(data)
+        # print_json_to_file(output_dir+ "qa_all.json", json_data, batch_mode=True)
+        # If IR was unsuccessful when it came to retrieving documents for the given question there is no abstract
+        if any(abstracts):
+            # get the answers for questions with relevant concepts
+            get_answer(data,output_dir,batch_mode=True,batch_inputs=batch_inputs)
+    print(f"{MAGENTA}Read {input_file} in {time.perf_counter() - start:.2f}s{OFF}")
     
-    # Now that the intermediary files are generated, pass them into qa scripts. 
     _,_,factoid_path,yesno_path,list_path = setup_file_system(output_dir,True)
 
     factoid_file_path = factoid_path + "qa_factoids.json"
     yesno_file_path = yesno_path + "qa_yesno.json"
     list_file_path = list_path + "qa_list.json"
+    for q_type, file_path in (("yesno", yesno_file_path), ("factoid", factoid_file_path), ("list", list_file_path)):
+        if batch_inputs[q_type]['data']:
+            print_json_to_file(file_path, batch_inputs[q_type])
+        elif os.path.exists(file_path):
+            # do not answer the questions left over from an earlier run
+            os.remove(file_path)
+    # Now that the intermediary files are generated, pass them into qa scripts. 
     
     list_nbest = list_path+"nbest_predictions.json"
     factoid_nbest = factoid_path+"nbest_predictions.json"
     # We use predictions instead of nbest since yesno only has 2 options
     yesno_preds = yesno_path+"predictions.json" 
     # Run the biobert question answering code on our extracted question dataframes
-    run_qa_file('run_yesno.py',yesno_path, predict_file= yesno_file_path,question_type="yesno")
-    run_qa_file('run_factoid.py',factoid_path, predict_file= factoid_file_path,question_type="factoid")
-    run_qa_file('run_list.py',list_path, predict_file= list_file_path,question_type="list")
+    # the three types are independent, so they run concurrently, each runner in its own process
+    jobs = [
+        ("yesno", 'run_yesno.py', yesno_path, yesno_file_path),
+        ("factoid", 'run_factoid.py', factoid_path, factoid_file_path),
+        ("list", 'run_list.py', list_path, list_file_path),
+    ]
+    threads = qa_thread_budget(qa_jobs, qa_threads) if qa_jobs > 1 else qa_threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, qa_jobs)) as executor:
+        futures = [
+            executor.submit(run_qa_type, engines, question_type, filename, path, file_path, threads, qa_timeout)
+            for question_type, filename, path, file_path in jobs
+        ]
+        run_results = [future.result() for future in futures]
+    report_qa_timing(run_results, time.perf_counter() - start)
+    for run_result in run_results:
+        if run_result.status in ("failed", "timeout"):
+            print(f"{RED}{run_result.question_type} QA {run_result.status}, its answers are missing from the output{OFF}")
     
     # Run the nbest predictions through a file type transformer, then into BioASQ evaluation repo
-    while not os.path.exists(list_nbest):
-        time.sleep(1)
-    if os.path.isfile(list_nbest):
-        print(f"{MAGENTA}Migrating jsons to correct bioasq format!!{OFF}")
-        file_paths = (factoid_nbest, list_nbest, yesno_preds)
-        transform_to_bioasq(file_paths)
-
-
-
-
+    # every run has finished at this point and each type's old outputs were removed before it ran, so the
+    # transform only finds the predictions of the types that answered in this run
+    print(f"{MAGENTA}Migrating jsons to correct bioasq format!!{OFF}")
+    file_paths = (factoid_nbest, list_nbest, yesno_preds)
+    transform_to_bioasq(file_paths)
+    return run_results
@@ -19,10 +19,10 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import io
 import re
 import unicodedata
 import six
-import tensorflow as tf
 
 
 def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
@@ -122,7 +122,8 @@ def load_vocab(vocab_file):
   """Loads a vocabulary file into a dictionary."""
   vocab = collections.OrderedDict()
   index = 0
-  with tf.gfile.GFile(vocab_file, "r") as reader:
+  # plain io instead of tf.gfile, so tokenizing does not need TensorFlow
+  with io.open(vocab_file, "r", encoding="utf-8") as reader:
     while True:
       token = convert_to_unicode(reader.readline())
       if not token:
@@ -0,0 +1,221 @@
+"""
+torch_qa.py runs the fine-tuned BioBERT question answering models on PyTorch, the runtime QU already uses.
+
+The TF checkpoints under bert_models/new_weights/<question type> are converted once into transformers models:
+    python -m answer_processing.torch_qa --convert bert_models/torch
+factoid and list become a BertForQuestionAnswering (the runners' cls/squad span head maps onto qa_outputs) and yesno
+a BertForYesNo, the sigmoid head run_yesno.py puts on the [CLS] hidden state.
+
+TorchQAEngine answers with the converted models through the same interface as qa_engine.QAEngine. Feature
+conversion and write_predictions come from squad_utils, which the runners import them from and which does not load
+TensorFlow, so the answers and output files are the same and only --convert and --parity need TensorFlow. Check the conversion against the TF models with
+    python -m answer_processing.torch_qa --parity tmp/qa/
+"""
+from utils import *
+import argparse
+import json
+import os
+import shutil
+import time
+
+import torch
+from torch import nn
+from transformers import BertConfig, BertForQuestionAnswering, BertModel, BertPreTrainedModel
+
+import answer_processing.qa_engine as qa_engine
+import answer_processing.squad_utils as squad_utils
+
+TORCH_MODELS_DIR = os.path.join(qa_engine.BERT_MODELS_DIR, "torch")
+# the head each question type's checkpoint holds, TF variable under cls/squad/ -> transformers parameter
+HEADS = {
+    "factoid": {"output_weights": "qa_outputs.weight", "output_bias": "qa_outputs.bias"},
+    "list": {"output_weights": "qa_outputs.weight", "output_bias": "qa_outputs.bias"},
+    "yesno": {"output_weights_sgm": "classifier.weight", "output_bias_sgm": "classifier.bias"},
+}
+
+
+# run_yesno.py's create_model: one sigmoid logit from the last hidden state of the first ([CLS]) token, without
+# the pooler that BertForSequenceClassification would put in between
+class BertForYesNo(BertPreTrainedModel):
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.bert = BertModel(config, add_pooling_layer=False)
+        self.classifier = nn.Linear(config.hidden_size, 1)
+        self.init_weights()
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None):
+        sequence_output = self.bert(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+        return self.classifier(sequence_output[:, 0, :])
+
+
+def model_class(question_type):
+    return BertForYesNo if question_type == "yesno" else BertForQuestionAnswering
+
+
+# The transformers parameter name of a TF checkpoint variable, None for variables inference does not need
+# (optimizer slots, global_step, heads of other question types)
+def torch_name(tf_name, question_type):
+    parts = tf_name.split("/")
+    if parts[:2] == ["cls", "squad"]:
+        return HEADS[question_type].get(parts[-1])
+    if parts[0] != "bert" or parts[-1] in ("adam_m", "adam_v"):
+        return None
+    names = []
+    for part in parts:
+        if part.startswith("layer_"):
+            names += ["layer", part[len("layer_"):]]
+        elif part in ("kernel", "gamma"):
+            names.append("weight")
+        elif part == "beta":
+            names.append("bias")
+        else:
+            names.append(part)
+    # the embedding tables are variables of their own in TF and the weight of an Embedding in PyTorch
+    if names[-1].endswith("_embeddings"):
+        names.append("weight")
+    return ".".join(names)
+
+
+# Convert a question type's TF checkpoint into a transformers model saved in output_dir
+def convert_checkpoint(question_type, output_dir, bert_dir=qa_engine.BERT_MODELS_DIR, init_checkpoint=None):
+    import tensorflow as tf
+    if init_checkpoint is None:
+        init_checkpoint = os.path.join(bert_dir, "new_weights", question_type)
+    config = BertConfig.from_json_file(os.path.join(bert_dir, "config.json"))
+    model = model_class(question_type)(config)
+    state = model.state_dict()
+    reader = tf.train.load_checkpoint(init_checkpoint)
+    loaded = set()
+    for tf_name in sorted(reader.get_variable_to_shape_map()):
+        name = torch_name(tf_name, question_type)
+        if name is None or name not in state:
+            continue
+        array = reader.get_tensor(tf_name)
+        # TF dense kernels are [in, out], torch Linear weights [out, in]
+        if tf_name.endswith("/kernel"):
+            array = array.T
+        if tuple(array.shape) != tuple(state[name].shape):
+            raise ValueError(f"{tf_name} has shape {array.shape}, {name} expects {tuple(state[name].shape)}")
+        state[name] = torch.from_numpy(array.copy())
+        loaded.add(name)
+    # buffers such as position_ids are not parameters and have no TF counterpart
+    missing = [name for name, _ in model.named_parameters() if name not in loaded]
+    if missing:
+        raise ValueError(f"{init_checkpoint} has no variables for {', '.join(missing)}")
+    model.load_state_dict(state)
+    model.save_pretrained(output_dir)
+    shutil.copy(os.path.join(bert_dir, "vocab.txt"), os.path.join(output_dir, "vocab.txt"))
+    print(f"{MAGENTA}Converted the {question_type} QA model from {init_checkpoint} to {output_dir}{OFF}")
+
+
+# qa_engine.QAEngine with the encoder and head running on PyTorch
+class TorchQAEngine(qa_engine.QAEngine):
+
+    def __init__(self, question_type, model_dir, device=None, max_seq_length=384, doc_stride=128,
+                 max_query_length=64, predict_batch_size=8, n_best_size=20, max_answer_length=30,
+                 do_lower_case=True):
+        start = time.perf_counter()
+        self.question_type = question_type
+        # the TF-free port of the runner's helpers, so answering does not import TensorFlow
+        self.runner = squad_utils.runner(question_type)
+        qa_engine.init_options(self, max_seq_length, doc_stride, max_query_length, predict_batch_size, n_best_size,
+                               max_answer_length, do_lower_case)
+        self.init_checkpoint = model_dir
+        self.tokenizer = self.runner.tokenization.FullTokenizer(
+            vocab_file=os.path.join(model_dir, "vocab.txt"), do_lower_case=do_lower_case
+        )
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = device
+        self.model = model_class(question_type).from_pretrained(model_dir)
+        self.model.to(device)
+        self.model.eval()
+        print(f"{MAGENTA}Loaded {question_type} QA model from {model_dir} on {device} in {time.perf_counter() - start:.1f}s{OFF}")
+
+    def forward(self, batch):
+        inputs = {
+            name: torch.tensor([getattr(feature, name) for feature in batch], dtype=torch.long, device=self.device)
+            for name in ("input_ids", "input_mask", "segment_ids")
+        }
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=inputs["input_ids"], attention_mask=inputs["input_mask"], token_type_ids=inputs["segment_ids"]
+            )
+        if self.question_type == "yesno":
+            return {"logits": outputs.cpu().numpy()}
+        return {"start_logits": outputs.start_logits.cpu().numpy(), "end_logits": outputs.end_logits.cpu().numpy()}
+
+    def parameter_bytes(self):
+        return sum(p.numel() * p.element_size() for p in self.model.parameters())
+
+    def close(self):
+        self.model = None
+
+
+# Load a TorchQAEngine per question type from model_root/<question type>, returns a dict keyed by question type
+def load_torch_engines(model_root=TORCH_MODELS_DIR, question_types=qa_engine.QUESTION_TYPES, **kwargs):
+    return {
+        question_type: TorchQAEngine(question_type, os.path.join(model_root, question_type), **kwargs)
+        for question_type in question_types
+    }
+
+
+# Answer json_data with the TF model and the converted PyTorch model of question_type and compare them.
+# Returns (the largest absolute logit difference, the share of questions whose answer is the same)
+def parity_check(question_type, json_data, model_dir, bert_dir=qa_engine.BERT_MODELS_DIR, atol=1e-3):
+    tf_engine = qa_engine.QAEngine(question_type, bert_dir)
+    torch_engine = TorchQAEngine(question_type, model_dir, device=torch.device("cpu"))
+    examples = qa_engine.read_examples(tf_engine.runner, question_type, json_data)
+    _, tf_results = tf_engine.run(examples)
+    _, torch_results = torch_engine.run(examples)
+    max_diff = 0.0
+    for tf_result, torch_result in zip(tf_results, torch_results):
+        # the fields after unique_id hold the logits
+        for field in tf_result._fields[1:]:
+            diffs = [abs(a - b) for a, b in zip(getattr(tf_result, field), getattr(torch_result, field))]
+            max_diff = max([max_diff] + diffs)
+    tf_predictions, _ = tf_engine.predict(json_data)
+    torch_predictions, _ = torch_engine.predict(json_data)
+    tf_engine.close()
+    torch_engine.close()
+    # yesno predictions are [answer, logits], the others the answer text
+    answer = (lambda prediction: prediction[0]) if question_type == "yesno" else (lambda prediction: prediction)
+    agreeing = sum(
+        1 for qas_id, prediction in tf_predictions.items()
+        if qas_id in torch_predictions and answer(torch_predictions[qas_id]) == answer(prediction)
+    )
+    agreement = agreeing / len(tf_predictions) if tf_predictions else 1.0
+    colour = GREEN if max_diff <= atol else RED
+    print(f"{colour}{question_type}: max logit difference {max_diff:.2e} (tolerance {atol:.0e}), "
+          f"{agreement:.1%} of {len(tf_predictions)} answers agree{OFF}")
+    return max_diff, agreement
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_dir", default=qa_engine.BERT_MODELS_DIR, help="Folder holding config.json, vocab.txt and new_weights/")
+    parser.add_argument("--convert", metavar="OUTPUT_ROOT",
+                        help="Convert every question type's TF checkpoint to a PyTorch model under OUTPUT_ROOT/<question type>")
+    parser.add_argument("--parity", metavar="INPUT_DIR",
+                        help="Compare the TF and PyTorch models on the batch mode QA inputs in INPUT_DIR (e.g. tmp/qa/)")
+    parser.add_argument("--model_root", default=TORCH_MODELS_DIR, help="Folder holding the converted PyTorch models")
+    parser.add_argument("--atol", type=float, default=1e-3, help="Largest logit difference --parity accepts")
+    args = parser.parse_args()
+    if args.convert:
+        for question_type in qa_engine.QUESTION_TYPES:
+            convert_checkpoint(question_type, os.path.join(args.convert, question_type), args.bert_dir)
+    if args.parity:
+        model_root = args.convert or args.model_root
+        failed = False
+        for question_type, file_name in qa_engine.INPUT_FILES.items():
+            path = os.path.join(args.parity, question_type, file_name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as f:
+                max_diff, _ = parity_check(
+                    question_type, json.load(f), os.path.join(model_root, question_type), args.bert_dir, args.atol
+                )
+            failed = failed or max_diff > args.atol
+        if failed:
+            raise SystemExit(1)
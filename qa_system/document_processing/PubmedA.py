@@ -28,3 +28,29 @@ class PubmedA:
         return f"PMID: {self.pmid}\nTitle: {self.title}\nJournal: {self.journal} | {self.year}\nAbstract Text: {self.abstract_text}\nMESH major: {self.mesh_major}"
 
 
+
+
+class LazyPubmedA(PubmedA):
+    """
+    A PubmedA that holds only its document number (and any fields it was
+    given). The stored fields are read from the index the first time one
+    of the others is accessed, loader(docnum) returns all the stored fields
+    of the document, so it is called at most once.
+    """
+    FIELDS = ("pmid", "title", "journal", "year", "abstract_text", "mesh_major")
+
+    def __init__(self, docnum: int, loader, fields: dict = None):
+        self.docnum = docnum
+        self.loader = loader
+        for name, value in (fields or {}).items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # only called for attributes that have not been set yet
+        if name not in LazyPubmedA.FIELDS:
+            raise AttributeError(name)
+        stored = self.loader(self.docnum)
+        for field in LazyPubmedA.FIELDS:
+            if field not in self.__dict__:
+                setattr(self, field, stored.get(field))
+        return self.__dict__[name]
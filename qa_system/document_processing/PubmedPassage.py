@@ -0,0 +1,15 @@
+"""
+This forms the object that encodes a passage (sentence) hit on the PubMed passage Index
+"""
+class PubmedPassage:
+
+    def __init__(self, pmid: str, section: str, offset: int,
+                 passage_text: str, score: float = None):
+        self.pmid = pmid
+        self.section = section
+        self.offset = offset
+        self.passage_text = passage_text
+        self.score = score
+
+    def __str__(self):
+        return f"PMID: {self.pmid} | {self.section} @ {self.offset}\nPassage Text: {self.passage_text}"
@@ -1,93 +1,338 @@
 # Based on code from https://github.com/masonnlp/bioasqir
 
 import lxml.etree as ET
+import math
 import os
+import sys
+import time
 from utils import *
+from whoosh.qparser import QueryParser, OrGroup
+from whoosh.query import Or
+from whoosh.matching import WrappingMatcher
+from whoosh.collectors import TimeLimitCollector
+from whoosh.searching import TimeLimit
 
-import document_processing.PubmedA
+from document_processing import PubmedA
+from document_processing import PubmedPassage
+
+# the PubMed index is built, and its PMID table and passage index read, by the sibling pubmed_indexer directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "pubmed_indexer"))
+import PubmedIndexer
+
+# opened PMID tables, keyed by index folder
+pmid_tables = {}
+# running totals over every search, "partial" counts the searches cut short by their time budget,
+# "hits" counts the searches that returned at least one article
+search_stats = {"searches": 0, "partial": 0, "hits": 0, "elapsed": 0.0}
+# In "or" query mode documents matching more of the query terms get a bonus scaled by this factor (0 disables it)
+COORDINATION_SCALE = 0.9
+# QueryParsers using OrGroup, keyed by (field, coordination scale)
+or_parsers = {}
+
+# The list of PubmedA returned by search, along with how the search went.
+# partial is True when the time budget ran out and only the best results collected so far are returned.
+# searcher is the searcher lazy results read their fields through, close() releases it once they have been read.
+class SearchResults(list):
+    partial = False
+    elapsed = 0.0
+    searcher = None
+
+    def close(self):
+        if self.searcher is not None:
+            self.searcher.close()
+            self.searcher = None
+
+# Whoosh 2.7 accepts Or(minmatch=...) but never enforces it, so min_should_match is applied by this matcher:
+# it passes on the documents of the wrapped Or matcher that at least minmatch of the counter matchers (one per
+# subquery, only ever moved forward) also match
+class MinMatchMatcher(WrappingMatcher):
+
+    def __init__(self, child, counters, minmatch, boost=1.0):
+        super(MinMatchMatcher, self).__init__(child, boost=boost)
+        self.counters = counters
+        self.minmatch = minmatch
+        self._find_next()
+
+    def copy(self):
+        return self.__class__(self.child.copy(), [c.copy() for c in self.counters], self.minmatch, boost=self.boost)
+
+    def _replacement(self, newchild):
+        return self.__class__(newchild, self.counters, self.minmatch, boost=self.boost)
+
+    def reset(self):
+        self.child.reset()
+        for counter in self.counters:
+            counter.reset()
+        self._find_next()
+
+    def _matches(self, id):
+        count = 0
+        for counter in self.counters:
+            if counter.is_active() and counter.id() < id:
+                counter.skip_to(id)
+            if counter.is_active() and counter.id() == id:
+                count += 1
+        return count
+
+    def _find_next(self):
+        child = self.child
+        while child.is_active() and self._matches(child.id()) < self.minmatch:
+            child.next()
+
+    def next(self):
+        self.child.next()
+        self._find_next()
+
+    def skip_to(self, id):
+        self.child.skip_to(id)
+        self._find_next()
+
+    def all_ids(self):
+        m = self.copy()
+        m.reset()
+        while m.is_active():
+            yield m.id()
+            m.next()
+
+    # quality skipping would move the child past documents without the counters seeing them
+    def supports_block_quality(self):
+        return False
+
+
+# An Or that only matches documents matching at least minmatch of its subqueries
+class MinShouldMatchOr(Or):
+
+    def matcher(self, searcher, context=None):
+        m = Or.matcher(self, searcher, context)
+        if self.minmatch <= 1 or len(self.subqueries) < 2 or not m.is_active():
+            return m
+        counters = [q.matcher(searcher, searcher.boolean_context()) for q in self.subqueries]
+        return MinMatchMatcher(m, counters, self.minmatch)
+
+# Turn the query text into a whoosh query.
+# query_mode "and" is the parser's default implicit AND over all terms.
+# query_mode "or" matches documents containing at least min_should_match of the terms (an int, or a fraction of
+# the number of terms) in a single search, with documents that match more terms scored higher.
+def build_query(parser, query_text, query_mode="and", min_should_match=1, coordination=COORDINATION_SCALE):
+    if query_mode == "and":
+        return parser.parse(query_text)
+    if query_mode != "or":
+        raise ValueError(f"Unknown query mode {query_mode}, expected 'and' or 'or'")
+    key = (parser.fieldname, coordination)
+    if key not in or_parsers:
+        or_parsers[key] = QueryParser(parser.fieldname, schema=parser.schema, group=OrGroup.factory(coordination))
+    q = or_parsers[key].parse(query_text)
+    if isinstance(q, Or):
+        num_terms = len(q.subqueries)
+        if isinstance(min_should_match, float) and min_should_match < 1:
+            min_should_match = math.ceil(min_should_match * num_terms)
+        q = MinShouldMatchOr(q.subqueries, boost=q.boost, minmatch=max(1, min(int(min_should_match), num_terms)),
+                             scale=q.scale)
+    return q
+
+# Run q on the searcher for up to max_results documents, collecting for at most time_budget seconds when one is set
+# Returns (the whoosh results, whether the time budget ran out)
+def collect(searcher, q, max_results, time_budget=None):
+    if not time_budget:
+        return searcher.search(q, limit=max_results), False
+    # use_alarm=False uses a timer thread instead of SIGALRM, which only works in the main thread
+    collector = TimeLimitCollector(searcher.collector(limit=max_results), timelimit=time_budget, use_alarm=False)
+    partial = False
+    try:
+        searcher.search_with_collector(q, collector)
+    except TimeLimit:
+        partial = True
+    return collector.results(), partial
 
 # Here we receive input of the form (id, question, type, entities, query).
 # We use this input to query the PubMed database index which has been specially indexed to improve query times.
-def search(indexer, parser, query, max_results = 5, batch_mode=False):
+# time_budget (seconds) bounds how long the search may collect documents for, None means no bound.
+# query_mode and min_should_match are described in build_query.
+# With fields set (e.g. ("pmid",) when only PMIDs are read) the results are LazyPubmedA built from the document
+# numbers alone: a hit's stored fields are decoded once, on first access, through the searcher the results keep
+# open until their close(). Hits that are never read are never decoded. None decodes every hit up front.
+def search(indexer, parser, query, max_results = 5, batch_mode=False, time_budget=None, query_mode="and", min_should_match=1, fields=None):
     print(f"{MAGENTA}Searching....{OFF}")
-    res = []
+    start = time.perf_counter()
+    res = SearchResults()
     if batch_mode:
-        q = parser.parse(query)
+        q = build_query(parser, query, query_mode, min_should_match)
     else:
-        q = parser.parse(query[4])
-    with indexer.searcher() as s:
-        results = s.search(q, limit=max_results)
+        q = build_query(parser, query[4], query_mode, min_should_match)
+    if fields is not None:
+        res.searcher = indexer.searcher()
+        results, res.partial = collect(res.searcher, q, max_results, time_budget)
+        # a Hit only decodes the stored fields when one is read, the document number is all that is kept
         for result in results:
-            pa = PubmedA.PubmedA(result.get('pmid'),
-                         result.get('title'),
-                         result.get('journal'),
-                         result.get('year'),
-                         result.get('abstract_text'),
-                         result.get('mesh_major')) # medical subject headings, keywords
-            res.append(pa)
+            res.append(PubmedA.LazyPubmedA(result.docnum, res.searcher.stored_fields))
+    else:
+        with indexer.searcher() as s:
+            results, res.partial = collect(s, q, max_results, time_budget)
+            for result in results:
+                pa = PubmedA.PubmedA(result.get('pmid'),
+                             result.get('title'),
+                             result.get('journal'),
+                             result.get('year'),
+                             result.get('abstract_text'),
+                             result.get('mesh_major')) # medical subject headings, keywords
+                res.append(pa)
+    res.elapsed = time.perf_counter() - start
+    search_stats["searches"] += 1
+    search_stats["elapsed"] += res.elapsed
+    if res:
+        search_stats["hits"] += 1
+    if res.partial:
+        search_stats["partial"] += 1
+        print(f"{YELLOW}Search hit its {time_budget}s time budget, returning {len(res)} partial results{OFF}")
     return res
 
+def print_search_stats():
+    searches = search_stats["searches"]
+    partial = search_stats["partial"]
+    hits = search_stats["hits"]
+    rate = partial / searches if searches else 0.0
+    hit_rate = hits / searches if searches else 0.0
+    mean_ms = 1000 * search_stats["elapsed"] / searches if searches else 0.0
+    print(f"{MAGENTA}{searches} searches, {hits} with results ({hit_rate:.1%}), mean {mean_ms:.1f} ms per query{OFF}")
+    print(f"{MAGENTA}{partial} cut short by the time budget ({rate:.1%}){OFF}")
+
+# Query the passage (sentence) index built alongside the article index by PubmedIndexer.
+# A single passage search gives the ranked snippets, their parent articles are then fetched by PMID.
+# time_budget, query_mode and min_should_match work as they do for search. The passages are returned as
+# SearchResults, whose partial flag tells whether the time budget ran out.
+def search_passages(indexer, passage_indexer, query, max_results = 5, batch_mode=False, time_budget=None, query_mode="and", min_should_match=1):
+    print(f"{MAGENTA}Searching passages....{OFF}")
+    start = time.perf_counter()
+    passages = SearchResults()
+    parser = QueryParser("passage_text", schema=passage_indexer.schema)
+    if batch_mode:
+        q = build_query(parser, query, query_mode, min_should_match)
+    else:
+        q = build_query(parser, query[4], query_mode, min_should_match)
+    with passage_indexer.searcher() as ps, indexer.searcher() as s:
+        results, passages.partial = collect(ps, q, max_results, time_budget)
+        hits, docs = PubmedIndexer.passage_hits(results, s)
+    for fields, score in hits:
+        passages.append(PubmedPassage.PubmedPassage(fields.get('pmid'),
+                                                    fields.get('section'),
+                                                    fields.get('offset'),
+                                                    fields.get('passage_text'),
+                                                    score))
+    articles = [stored_article(doc) for doc in docs]
+    passages.elapsed = time.perf_counter() - start
+    if passages.partial:
+        print(f"{YELLOW}Passage search hit its {time_budget}s time budget, returning {len(passages)} partial results{OFF}")
+    return passages, articles
+
+# The PubmedA of an article index document's stored fields
+def stored_article(fields):
+    return PubmedA.PubmedA(fields.get('pmid'),
+                           fields.get('title'),
+                           fields.get('journal'),
+                           fields.get('year'),
+                           fields.get('abstract_text'),
+                           fields.get('mesh_major'))
+
+# Fetch articles by PMID without searching, e.g. for gold documents that are only known by PMID.
+# Returns a dict of PMID -> PubmedA, PMIDs that are not in the index are left out.
+def get_by_pmid(indexer, pmids):
+    folder = indexer.storage.folder
+    if folder not in pmid_tables:
+        pmid_tables[folder] = PubmedIndexer.open_pmid_table(folder)
+    found = PubmedIndexer.stored_fields_by_pmid(indexer, pmid_tables[folder], pmids)
+    return {pmid: stored_article(fields) for pmid, fields in found.items()}
+
+# The tag and attributes of the root element of an XML file, read without parsing the rest of the file
+def root_element(input_file):
+    for _, root in ET.iterparse(input_file, events=("start",)):
+        return root.tag, dict(root.attrib)
+
 #Query the the PubMed index with every query generated in the QU module, writing the result articles fetched by query to a file every <write_buffer_size> iterations 
-def batch_search(input_file, output_file, indexer, parser, write_buffer_size=500):
-    fileTree = ET.parse(input_file)
-    if fileTree:
-        os.makedirs(os.path.dirname(input_file), exist_ok=True)
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-        root = fileTree.getroot()
-        # get all questions from the output file and parse in batch format
-        questions = root.findall('Q')
-        index = 1
-        num_questions = str((len(questions)))
-        print(f"{MAGENTA}{num_questions} questions found{OFF}")
-        for question in questions:
-            # Question ID and question processing tags
-            qid = question.get("id")
-            qp = question.find("QP")
-            # safeguard for malformed query
-            if qp.find("Query").text:
-                query = qp.find("Query").text
-            else:
-                print(f"{MAGENTA}No query found, using original question{OFF}")
-                query = question.text
-            print(f"{MAGENTA}{query} [{index}/{num_questions}]{OFF}")
-            # use search method to find a result
-            results = search(indexer,parser,query,batch_mode=True)
-            if results:
-                print(f"{MAGENTA}Results found.{OFF}")
-                ir = question.find("IR")
-                # create subelements for each result
-                for result in results:
-                    query_used = ET.SubElement(ir, "QueryUsed")
-                    query_used.text = query
-                    result_tag = ET.SubElement(ir, "Result")
-                    result_tag.set("PMID", result.pmid)
-                    journal = ET.SubElement(result_tag, "Journal")
-                    journal.text = result.journal
-                    year = ET.SubElement(result_tag, "Year")
-                    try:
-                        year.text = result.year
-                    except:
-                        pass
-                    title = ET.SubElement(result_tag, "Title")
-                    title.text = result.title
-                    abstract = ET.SubElement(result_tag, "Abstract")
-                    abstract.text = result.abstract_text
-                    # tags
-                    for mesh in result.mesh_major:
-                        mesh_major = ET.SubElement(result_tag, "MeSH")
-                        mesh_major.text = mesh
-                tree = ET.ElementTree(root)
-                # save current progress to file every n documents (controlled by write_buffer_size)
-                if(index % write_buffer_size-1 == 0):   
+#When fields is given only those stored fields (and the PMID) are written for each result
+#The input is read one <Q> at a time and each question is written out once it has been searched, so memory does not
+#grow with the number of questions
+def batch_search(input_file, output_file, indexer, parser, write_buffer_size=500, passage_indexer=None, time_budget=None, query_mode="and", min_should_match=1, fields=None):
+    os.makedirs(os.path.dirname(input_file), exist_ok=True)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    root_tag, root_attrib = root_element(input_file)
+    index = 0
+    with ET.xmlfile(output_file, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element(root_tag, root_attrib):
+            # get the questions from the QU output one at a time, blank text is dropped so the output pretty prints
+            for _, question in ET.iterparse(input_file, events=("end",), tag="Q", remove_blank_text=True):
+                index = index + 1
+                # Question ID and question processing tags
+                qid = question.get("id")
+                qp = question.find("QP")
+                # safeguard for malformed query
+                if qp.find("Query").text:
+                    query = qp.find("Query").text
+                else:
+                    print(f"{MAGENTA}No query found, using original question{OFF}")
+                    query = question.text
+                print(f"{MAGENTA}{query} [{index}]{OFF}")
+                # use search method to find a result
+                results = search(indexer,parser,query,batch_mode=True,time_budget=time_budget,
+                                 query_mode=query_mode,min_should_match=min_should_match,fields=fields)
+                print(f"{MAGENTA}{len(results)} results in {1000 * results.elapsed:.1f} ms{OFF}")
+                if results:
+                    print(f"{MAGENTA}Results found.{OFF}")
+                    ir = question.find("IR")
+                    if results.partial:
+                        ir.set("partial", "true")
+                    # create subelements for each result
+                    for result in results:
+                        query_used = ET.SubElement(ir, "QueryUsed")
+                        query_used.text = query
+                        result_tag = ET.SubElement(ir, "Result")
+                        result_tag.set("PMID", result.pmid)
+                        if fields is None or "journal" in fields:
+                            journal = ET.SubElement(result_tag, "Journal")
+                            journal.text = result.journal
+                        if fields is None or "year" in fields:
+                            year = ET.SubElement(result_tag, "Year")
+                            try:
+                                year.text = result.year
+                            except:
+                                pass
+                        if fields is None or "title" in fields:
+                            title = ET.SubElement(result_tag, "Title")
+                            title.text = result.title
+                        if fields is None or "abstract_text" in fields:
+                            abstract = ET.SubElement(result_tag, "Abstract")
+                            abstract.text = result.abstract_text
+                        # tags
+                        if fields is None or "mesh_major" in fields:
+                            for mesh in result.mesh_major:
+                                mesh_major = ET.SubElement(result_tag, "MeSH")
+                                mesh_major.text = mesh
+                else:
+                    print(f"{MAGENTA}No results{OFF}")
+                results.close()
+                # snippets straight from the passage index, when one was built
+                if passage_indexer is not None:
+                    passages, _ = search_passages(indexer,passage_indexer,query,batch_mode=True,time_budget=time_budget,
+                                                  query_mode=query_mode,min_should_match=min_should_match)
+                    ir = question.find("IR")
+                    if passages.partial:
+                        ir.set("snippets_partial", "true")
+                    for passage in passages:
+                        snippet = ET.SubElement(ir, "Snippet")
+                        snippet.set("PMID", passage.pmid)
+                        snippet.set("Section", passage.section)
+                        snippet.set("Offset", str(passage.offset))
+                        snippet.text = passage.passage_text
+                xf.write(question, pretty_print=True)
+                # the question has been written, drop it and the ones before it from the parsed tree
+                question.clear(keep_tail=True)
+                while question.getprevious() is not None:
+                    del question.getparent()[0]
+                # save current progress to file every n questions (controlled by write_buffer_size)
+                if index % write_buffer_size == 0:
                     print(f"{MAGENTA}Writing data to {output_file}{OFF}")
-                    tree.write(output_file, pretty_print=True)
-            else:
-                print(f"{MAGENTA}No results{OFF}")
-            index=index+1
-        print(f"{MAGENTA}Writing data to {output_file}{OFF}")
-        tree.write(output_file, pretty_print=True)
-    else:
-        print(f"{MAGENTA}Error loading {input_file}{OFF}")
+                    xf.flush()
+    print(f"{MAGENTA}Wrote {index} questions to {output_file}{OFF}")
+    print_search_stats()
 
 
@@ -6,25 +6,21 @@ This is the main file for the QA pipeline.
 """
 from utils import *
 
-import pandas as pd
-import torch
-from transformers import BertTokenizer, BertForSequenceClassification
-import spacy
-import en_core_sci_lg
 import os
 import shutil
 import argparse
+import time
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 
-from whoosh import index
-from whoosh.fields import Schema, TEXT, IDLIST, ID, NUMERIC
-from whoosh.analysis import StemmingAnalyzer
-from whoosh.qparser import QueryParser
-
+# torch, transformers, spacy, whoosh, pandas and the analysis module are imported by the loaders below,
+# so each run only pays for the stages it uses and the loads overlap in background threads
 import setup
 import question_processing.question_understanding as question_understanding
-import document_processing.information_retrieval as information_retrieval
+import question_processing.qu_cache as qu_cache
+import question_processing.type_cascade as type_cascade
+import question_processing.synonyms as synonyms
 import answer_processing.question_answering as question_answering
-import analysis_and_evaluation.analysis
 
 def cleanup():
     clear_tmp_dir("tmp/qu")
@@ -38,6 +34,218 @@ def clean_qa():
 
 
 
+# Load the QU type classifier, quantized to int8 for cpu inference when asked to
+# With onnx=True the exported ONNX model is run with ONNX Runtime if it exists, otherwise it falls back to torch
+def load_qu_model(model_path, quantize=False, onnx=False, intra_op_threads=0, inter_op_threads=0):
+    if onnx:
+        model = question_understanding.load_onnx_classifier(model_path, intra_op_threads, inter_op_threads)
+        if model is not None:
+            print(f"{MAGENTA}Using ONNX Runtime QU model {model.path}{OFF}")
+            return model
+        print(f"{YELLOW}No {question_understanding.ONNX_MODEL_NAME} in {model_path}, falling back to torch{OFF}")
+    from transformers import BertForSequenceClassification
+    model = BertForSequenceClassification.from_pretrained(model_path, cache_dir=None)
+    if quantize:
+        print(f"{MAGENTA}Quantizing QU model to int8...{OFF}")
+        return question_understanding.quantize_model(model)
+    return model
+
+
+# Open the persistent QU cache at path (None if caching is disabled), stamped with the QU models it was filled from:
+# the files the type classifier is loaded from and the scispaCy pipeline nlp, which extracts the entities
+# cascade_threshold is set when the type cascade is on, since it can type questions differently than BERT alone
+# synonym_table is stamped too, since the expanded queries depend on the table and its caps
+def open_qu_cache(path, model_path, model, nlp, quantize=False, cascade_threshold=None, synonym_table=None):
+    if not path:
+        return None
+    if isinstance(model, question_understanding.OnnxQuestionClassifier):
+        files = [question_understanding.ONNX_MODEL_NAME]
+    else:
+        from transformers import CONFIG_NAME, WEIGHTS_NAME
+        files = [CONFIG_NAME, WEIGHTS_NAME]
+    if cascade_threshold is not None:
+        files.append(type_cascade.CASCADE_MODEL_NAME)
+    synonym_stamp = None
+    if synonym_table is not None:
+        synonym_stamp = f"{os.path.getmtime(synonym_table.path)}/{synonym_table.max_synonyms}/{synonym_table.max_query_synonyms}"
+    version = qu_cache.model_version(
+        model_path,
+        files,
+        mode=f"{type(model).__name__}:quantize={quantize}:cascade={cascade_threshold}:synonyms={synonym_stamp}"
+             f":nlp={nlp.meta['name']}-{nlp.meta['version']}",
+    )
+    print(f"{MAGENTA}Using QU cache {path}{OFF}")
+    return qu_cache.QUCache(path, version)
+
+
+# Run QU over the question CSV qu_input and write the IR input xml to output_file,
+# streaming the CSV in chunks of args.chunksize questions when it is set
+def run_batch_qu(qu_input, output_file, args, device, tokenizer, model, nlp, cache=None, cascade=None, synonym_table=None):
+    if args.chunksize:
+        question_understanding.ask_and_receive_stream(
+            input_file=qu_input,
+            output_file=output_file,
+            device=device,
+            tokenizer=tokenizer,
+            model=model,
+            nlp=nlp,
+            chunksize=args.chunksize,
+            batch_size=args.qu_batch_size,
+            n_process=args.n_process,
+            cache=cache,
+            cascade=cascade,
+            synonyms=synonym_table,
+        )
+    else:
+        import pandas as pd
+        questions_df = pd.read_csv(qu_input, sep=",", header=0)
+        question_understanding.ask_and_receive(
+            questions_df=questions_df,
+            device=device,
+            tokenizer=tokenizer,
+            model=model,
+            nlp=nlp,
+            cache=cache,
+            cascade=cascade,
+            synonyms=synonym_table,
+            batch_size=args.qu_batch_size,
+            n_process=args.n_process,
+            batch_mode=True,
+            output_file=output_file,
+        )
+
+
+# Open the UMLS synonym table for query expansion, None if it has not been compiled
+def load_synonyms(path, max_synonyms, max_query_synonyms):
+    if not path or not os.path.exists(path):
+        return None
+    print(f"{MAGENTA}Loading synonym table {path}...{OFF}")
+    return synonyms.SynonymTable(path, max_synonyms=max_synonyms, max_query_synonyms=max_query_synonyms)
+
+
+# Runs the startup loads in background threads, so independent loads overlap and the caller only blocks on a
+# load when it first needs its result. Loads are kept by name, so asking for the same load twice reuses it.
+class StartupLoader:
+
+    def __init__(self, max_workers=3):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="loader")
+        self.futures = {}
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    def submit(self, name, fn, *args, **kwargs):
+        if name not in self.futures:
+            self.futures[name] = self.executor.submit(self._timed, name, fn, *args, **kwargs)
+        return self.futures[name]
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.timings[name] = (start - self.start, time.perf_counter() - start)
+        return result
+
+    def get(self, name):
+        return self.futures[name].result()
+
+    def report(self):
+        print(f"{MAGENTA}Startup timings:{OFF}")
+        for name, (offset, seconds) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            print(f"{MAGENTA}  {name}: {seconds:.2f}s (started at +{offset:.2f}s){OFF}")
+        print(f"{MAGENTA}  all loads done {time.perf_counter() - self.start:.2f}s after startup{OFF}")
+
+
+# Load the QU type classifier and the cache, cascade and synonym table QU runs with
+# nlp_future is the scispaCy load, the cache waits on it to stamp the pipeline version
+# returns (device, tokenizer, model, cache, cascade, synonym_table)
+def load_qu(args, model_path, nlp_future):
+    from transformers import BertTokenizerFast
+    print(f"{MAGENTA}Initializing model...{OFF}")
+    if args.onnx or args.quantize:
+        # the int8 and ONNX Runtime models only run on cpu, and the ONNX path does not need torch at all
+        device = "cpu"
+    else:
+        import torch
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+    model = load_qu_model(
+        model_path,
+        quantize=args.quantize,
+        onnx=args.onnx,
+        intra_op_threads=args.onnx_intra_threads,
+        inter_op_threads=args.onnx_inter_threads,
+    )
+    synonym_table = load_synonyms(args.synonyms, args.max_synonyms, args.max_query_synonyms)
+    cache = open_qu_cache(
+        args.qu_cache, model_path, model, nlp_future.result(), quantize=args.quantize,
+        cascade_threshold=args.cascade_threshold if args.cascade else None,
+        synonym_table=synonym_table,
+    )
+    cascade = None
+    if args.cascade:
+        cascade = type_cascade.load_cascade(model_path, threshold=args.cascade_threshold)
+    return device, tokenizer, model, cache, cascade, synonym_table
+
+
+# load in the scispaCy pipeline QU extracts entities with
+def load_nlp():
+    import spacy
+    import en_core_sci_lg
+    # This is for cpu support for non-NVIDIA cuda-capable machines.
+    spacy.prefer_gpu()
+    print(f"{MAGENTA}Loading BioBERT...{OFF}")
+    return en_core_sci_lg.load()
+
+
+# Open the article index, the optional passage index and the query parser IR searches with
+# returns (pubmed_article_ix, pubmed_passage_ix, qp)
+def load_index(index_path, article_index_name, passage_index_name):
+    from whoosh import index
+    from whoosh.fields import Schema, TEXT, IDLIST, ID, NUMERIC
+    from whoosh.analysis import StemmingAnalyzer
+    from whoosh.qparser import QueryParser
+    print(f"{MAGENTA}Loading index...{OFF}")
+    # This is the schema for each query retrieved from Pubmed
+    pubmed_article_ix = index.open_dir(index_path, indexname=article_index_name)
+    # the passage index is optional, it is only there if the indexer was run with --passages
+    pubmed_passage_ix = None
+    if index.exists_in(index_path, indexname=passage_index_name):
+        print(f"{MAGENTA}Loading passage index...{OFF}")
+        pubmed_passage_ix = index.open_dir(index_path, indexname=passage_index_name)
+    qp = QueryParser(
+        "abstract_text",
+        schema=Schema(
+            pmid=ID(stored=True),
+            title=TEXT(stored=True),
+            journal=TEXT(stored=True),
+            mesh_major=IDLIST(stored=True),
+            year=NUMERIC(stored=True),
+            abstract_text=TEXT(stored=True, analyzer=StemmingAnalyzer()),
+        ),
+    )
+    return pubmed_article_ix, pubmed_passage_ix, qp
+
+
+# Load the factoid, list and yesno BioBERT models for in-process question answering, or clients for a running
+# answer_processing/qa_server.py with the server backend. None when QA runs the runner scripts as subprocesses
+# threads caps the intra-op threads of every in-process engine, 0 leaves it to TensorFlow
+def load_qa_engines(backend, server_url=None, threads=0, merged_checkpoint=None, saved_model_dir=None, torch_model_dir=None):
+    if backend == "server":
+        import answer_processing.qa_server as qa_server
+        return qa_server.remote_engines(server_url)
+    if backend == "torch":
+        import answer_processing.torch_qa as torch_qa
+        return torch_qa.load_torch_engines(torch_model_dir)
+    if backend not in ("inprocess", "multihead", "savedmodel"):
+        return None
+    import answer_processing.qa_engine as qa_engine
+    session_config = qa_engine.thread_config(threads, 1) if threads > 0 else None
+    if backend == "multihead":
+        return qa_engine.MultiHeadQAEngine(merged_checkpoint=merged_checkpoint, session_config=session_config).heads()
+    if backend == "savedmodel":
+        return qa_engine.load_saved_models(saved_model_dir, session_config=session_config)
+    return qa_engine.load_engines(session_config=session_config)
+
+
 def clear_tmp_dir(dir):
     print(f"{WHITE}cleaning {dir}{OFF}")
     for files in os.listdir(dir):
@@ -72,6 +280,205 @@ if __name__ == "__main__":
         help="This defines the golden dataset for the system. Point this at testing_datasets/augmented_concepts_abstracts_titles.json by default",
         type=str,
     )
+    parser.add_argument(
+        "-t",
+        "--time_budget",
+        dest="time_budget",
+        help="Per-query time budget in seconds for IR searches. When it runs out the best results found so far are used.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "-m",
+        "--query_mode",
+        dest="query_mode",
+        choices=["and", "or"],
+        default="and",
+        help="How IR combines the query terms: 'and' requires all of them, 'or' requires at least --min_should_match of them and ranks documents matching more terms higher.",
+    )
+    parser.add_argument(
+        "--min_should_match",
+        dest="min_should_match",
+        help="Minimum number of query terms (or fraction of them if below 1) a document must match in 'or' query mode.",
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        "--ir_pmids_only",
+        dest="ir_pmids_only",
+        action="store_true",
+        help="In the IR evaluations (options 2 and 4) only read and write the PMIDs of the results, which is all the IR evaluation uses. The IR output then cannot be used for QA (option 3).",
+    )
+    parser.add_argument(
+        "--qu_batch_size",
+        dest="qu_batch_size",
+        help="Number of questions per QU type classification batch. By default the batch size is tuned per length bucket.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--n_process",
+        dest="n_process",
+        help="Number of processes scispaCy uses for QU entity extraction in batch runs.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-q",
+        "--quantize",
+        dest="quantize",
+        action="store_true",
+        help="Run the QU type classifier with dynamic int8 quantization on cpu.",
+    )
+    parser.add_argument(
+        "--check_quantized",
+        dest="check_quantized",
+        action="store_true",
+        help="In evaluation mode, compare the int8 QU model against the fp32 model on the gold question types before running.",
+    )
+    parser.add_argument(
+        "--onnx",
+        dest="onnx",
+        action="store_true",
+        help="Run the QU type classifier with ONNX Runtime on cpu. Falls back to torch if the model has not been exported with --export_onnx. Cannot be combined with --quantize.",
+    )
+    parser.add_argument(
+        "--export_onnx",
+        dest="export_onnx",
+        action="store_true",
+        help="Export the QU type classifier to ONNX next to the torch model and exit.",
+    )
+    parser.add_argument(
+        "--onnx_intra_threads",
+        dest="onnx_intra_threads",
+        help="Threads ONNX Runtime uses within an operator (0 lets ONNX Runtime choose).",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--onnx_inter_threads",
+        dest="onnx_inter_threads",
+        help="Threads ONNX Runtime uses across independent operators (0 lets ONNX Runtime choose).",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--qu_cache",
+        dest="qu_cache",
+        help="SQLite file caching QU results by normalized question text. Pass an empty string to disable the cache.",
+        type=str,
+        default="data_modules/qu_cache.sqlite",
+    )
+    parser.add_argument(
+        "--cascade",
+        dest="cascade",
+        action="store_true",
+        help="Type questions with first-word rules and a TF-IDF linear model first and only escalate uncertain questions to BERT.",
+    )
+    parser.add_argument(
+        "--cascade_threshold",
+        dest="cascade_threshold",
+        help="Minimum linear model probability for the type cascade to answer without BERT.",
+        type=float,
+        default=type_cascade.DEFAULT_THRESHOLD,
+    )
+    parser.add_argument(
+        "--train_cascade",
+        dest="train_cascade",
+        action="store_true",
+        help="Train the linear stage of the type cascade on the gold dataset given with -g and exit.",
+    )
+    parser.add_argument(
+        "--chunksize",
+        dest="chunksize",
+        help="Stream batch QU over the question CSV this many questions at a time, appending to the IR input file after each chunk.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--synonyms",
+        dest="synonyms",
+        help="Synonym table compiled with question_processing/synonyms.py, used to expand query entities if it exists.",
+        type=str,
+        default="data_modules/synonyms.bin",
+    )
+    parser.add_argument(
+        "--max_synonyms",
+        dest="max_synonyms",
+        help="Maximum number of synonyms added to the query per entity.",
+        type=int,
+        default=synonyms.DEFAULT_MAX_SYNONYMS,
+    )
+    parser.add_argument(
+        "--max_query_synonyms",
+        dest="max_query_synonyms",
+        help="Maximum number of synonyms added to a whole query.",
+        type=int,
+        default=synonyms.DEFAULT_MAX_QUERY_SYNONYMS,
+    )
+    parser.add_argument(
+        "--qa_backend",
+        dest="qa_backend",
+        choices=["inprocess", "multihead", "savedmodel", "torch", "server", "subprocess"],
+        default="inprocess",
+        help="'inprocess' loads the BioBERT QA models once and answers in this process, 'multihead' loads one BioBERT encoder shared by the factoid, list and yesno heads, 'savedmodel' loads the SavedModels exported to --qa_saved_model_dir, 'torch' runs the PyTorch conversions in --qa_torch_model_dir, 'server' sends questions to a running answer_processing/qa_server.py, 'subprocess' runs the run_*.py scripts for every QA run.",
+    )
+    parser.add_argument(
+        "--qa_merged_checkpoint",
+        dest="qa_merged_checkpoint",
+        help="Checkpoint written by 'python -m answer_processing.qa_engine --export_merged', loaded by --qa_backend multihead in one restore.",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--qa_saved_model_dir",
+        dest="qa_saved_model_dir",
+        help="Folder 'python -m answer_processing.qa_engine --export_saved_model' exported the QA models to, used by --qa_backend savedmodel.",
+        type=str,
+        default="bert_models/saved_model",
+    )
+    parser.add_argument(
+        "--qa_torch_model_dir",
+        dest="qa_torch_model_dir",
+        help="Folder 'python -m answer_processing.torch_qa --convert' wrote the PyTorch QA models to, used by --qa_backend torch.",
+        type=str,
+        default="bert_models/torch",
+    )
+    parser.add_argument(
+        "--qa_server_url",
+        dest="qa_server_url",
+        help="URL of the QA server used by --qa_backend server.",
+        type=str,
+        default="http://127.0.0.1:8765",
+    )
+    parser.add_argument(
+        "--qa_jobs",
+        dest="qa_jobs",
+        help="Number of question types (yesno, factoid, list) answered at the same time in batch mode, 1 runs them in turn.",
+        type=int,
+        default=question_answering.QA_JOBS,
+    )
+    parser.add_argument(
+        "--qa_threads",
+        dest="qa_threads",
+        help="Threads each QA job may use. Defaults to the number of cores divided by --qa_jobs in batch mode.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--qa_passages",
+        dest="qa_passages",
+        help="Number of top retrieved abstracts each question is answered over.",
+        type=int,
+        default=question_answering.QA_PASSAGES,
+    )
+    parser.add_argument(
+        "--qa_timeout",
+        dest="qa_timeout",
+        help="Seconds a batch mode QA runner may run before it is killed. Defaults to no limit.",
+        type=float,
+        default=None,
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -90,14 +497,44 @@ if __name__ == "__main__":
         raise argparse.ArgumentError(
             "You must define an golden dataset along with a input file with qa_system.py -E -g <gold_file_name> -i <input_file_name> if you want to run evaluations"
         )
+    if args.onnx and args.quantize:
+        # the ONNX Runtime model is exported from the fp32 model, it would run without the int8 quantization
+        raise argparse.ArgumentError(
+            None, "--quantize only applies to the torch QU model, use either --onnx or --quantize"
+        )
     # This ensures that all the packages are installed so that the system can work with the modules
     data_folder = "data_modules"
     setup.setup_system(data_folder)
     index_folder_name = "index"
     model_folder_name = "model"
     pubmed_official_index_name = "pubmed_articles"
+    pubmed_passage_index_name = "pubmed_passages"
+    index_var = "full_index"
+    model_path = data_folder + os.path.sep + model_folder_name
+    index_path = data_folder + os.path.sep + index_folder_name + os.path.sep + index_var
+    if args.train_cascade:
+        if not args.gold:
+            raise argparse.ArgumentError(
+                None, "You must define a golden dataset with qa_system.py --train_cascade -g <gold_file_name>"
+            )
+        import analysis_and_evaluation.analysis as analysis
+        type_cascade.train(
+            analysis.get_gold_df(args.gold),
+            data_folder + os.path.sep + model_folder_name + os.path.sep + type_cascade.CASCADE_MODEL_NAME,
+        )
+        quit()
+    if args.export_onnx:
+        from transformers import BertTokenizerFast
+        question_understanding.export_onnx(
+            load_qu_model(model_path),
+            BertTokenizerFast.from_pretrained("bert-base-uncased"),
+            model_path + os.path.sep + question_understanding.ONNX_MODEL_NAME,
+        )
+        quit()
     if args.evaluate:
         print(f"System is in EVAL mode <{GREEN}{args.evaluate}{OFF}>")
+        import analysis_and_evaluation.analysis as analysis
+        loader = StartupLoader()
 
         while True:
             # NORMAL VALUES
@@ -157,41 +594,45 @@ if __name__ == "__main__":
                 if result in eval_options_dict.keys():
                     print(f"{MAGENTA}{eval_options_dict.get(result)} selected.{OFF}")
 
-                # do setup for modules using QU
+                # start the loads the selected modules need, each runs in the background and only once per session
                 if result in ["0","1","4"]:
-                    # This is for cpu support for non-NVIDIA cuda-capable machines.
-                    spacy.prefer_gpu()
-                    # initialize model
-                    print(f"{MAGENTA}Initializing model...{OFF}")
-                    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-                    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-                    model = BertForSequenceClassification.from_pretrained(
-                        data_folder + os.path.sep + model_folder_name, cache_dir=None
+                    loader.submit("QU model", load_qu, args, model_path, loader.submit("scispaCy", load_nlp))
+                if result in ["0","2", "4", "5"]:
+                    loader.submit("index", load_index, index_path, pubmed_official_index_name, pubmed_passage_index_name)
+                if result in ["0","3","5"]:
+                    loader.submit(
+                        "QA models", load_qa_engines, args.qa_backend, args.qa_server_url,
+                        question_answering.qa_thread_budget(args.qa_jobs, args.qa_threads) if args.qa_jobs > 1 else args.qa_threads,
+                        args.qa_merged_checkpoint,
+                        args.qa_saved_model_dir,
+                        args.qa_torch_model_dir,
                     )
-                    # load in BioBERT
-                    print(f"{MAGENTA}Loading BioBERT...{OFF}")
-                    nlp = en_core_sci_lg.load()
+                # do setup for modules using QU
+                if result in ["0","1","4"]:
+                    device, tokenizer, model, cache, cascade, synonym_table = loader.get("QU model")
+                    if args.check_quantized:
+                        print(f"{MAGENTA}Comparing int8 and fp32 QU models...{OFF}")
+                        fp32_model = load_qu_model(model_path)
+                        question_understanding.check_quantized(
+                            analysis.get_gold_df(args.gold),
+                            tokenizer,
+                            fp32_model,
+                            # --quantize excludes --onnx, so model is the torch int8 model here
+                            model if args.quantize else question_understanding.quantize_model(
+                                load_qu_model(model_path)
+                            ),
+                            batch_size=args.qu_batch_size,
+                        )
+                    nlp = loader.get("scispaCy")
                 # do setup for IR
                 if result in ["0","2", "4", "5"]:
-                    # load index
-                    index_var = "full_index"
-                    print(f"{MAGENTA}Loading index...{OFF}")
-                    # This is the schema for each query retrieved from Pubmed
-                    pubmed_article_ix = index.open_dir(
-                        data_folder + os.path.sep + index_folder_name + os.path.sep + index_var,
-                        indexname=pubmed_official_index_name,
-                    )
-                    qp = QueryParser(
-                        "abstract_text",
-                        schema=Schema(
-                            pmid=ID(stored=True),
-                            title=TEXT(stored=True),
-                            journal=TEXT(stored=True),
-                            mesh_major=IDLIST(stored=True),
-                            year=NUMERIC(stored=True),
-                            abstract_text=TEXT(stored=True, analyzer=StemmingAnalyzer()),
-                        ),
-                    )
+                    import document_processing.information_retrieval as information_retrieval
+                    pubmed_article_ix, pubmed_passage_ix, qp = loader.get("index")
+                # do setup for QA
+                if result in ["0","3","5"]:
+                    engines = loader.get("QA models")
+                if result in ["0","1","2","3","4","5"]:
+                    loader.report()
                 
                 if result == "0":
                     # Run Full System
@@ -199,25 +640,36 @@ if __name__ == "__main__":
                     # use the question list from user
                     qu_input = args.input
 
-                    questions_df = pd.read_csv(qu_input, sep=",", header=0)
-                    question_understanding.ask_and_receive(
-                        questions_df=questions_df,
+                    run_batch_qu(
+                        qu_input,
+                        ir_input_generated,
+                        args,
                         device=device,
                         tokenizer=tokenizer,
                         model=model,
                         nlp=nlp,
-                        batch_mode=True,
-                        output_file=ir_input_generated,
+                        cache=cache,
+                        cascade=cascade,
+                        synonym_table=synonym_table,
                     )
                     information_retrieval.batch_search(
                         input_file=ir_input_generated,
                         output_file=ir_output_generated,
                         indexer=pubmed_article_ix,
                         parser=qp,
+                        passage_indexer=pubmed_passage_ix,
+                        time_budget=args.time_budget,
+                        query_mode=args.query_mode,
+                        min_should_match=args.min_should_match,
                     )
                     question_answering.run_batch_mode(
                         input_file=ir_output_generated,
                         output_dir=qa_output_generated_dir,
+                        engines=engines,
+                        qa_jobs=args.qa_jobs,
+                        qa_threads=args.qa_threads,
+                        passages=args.qa_passages,
+                        qa_timeout=args.qa_timeout,
                     )
                     # Run tests
                     print("Running tests")
@@ -237,10 +689,19 @@ if __name__ == "__main__":
                         output_file=ir_output_generated,
                         indexer=pubmed_article_ix,
                         parser=qp,
+                        passage_indexer=pubmed_passage_ix,
+                        time_budget=args.time_budget,
+                        query_mode=args.query_mode,
+                        min_should_match=args.min_should_match,
                     )
                     question_answering.run_batch_mode(
                         input_file=ir_output_generated,
                         output_dir=qa_output_generated_dir,
+                        engines=engines,
+                        qa_jobs=args.qa_jobs,
+                        qa_threads=args.qa_threads,
+                        passages=args.qa_passages,
+                        qa_timeout=args.qa_timeout,
                     )
                     # Run tests
                     print("Run tests with gold QU output")
@@ -261,7 +722,13 @@ if __name__ == "__main__":
                     # Run QA
                     print("Run QA")
                     question_answering.run_batch_mode(
-                        input_file=gold_ir_output, output_dir=qa_output_generated_dir
+                        input_file=gold_ir_output,
+                        output_dir=qa_output_generated_dir,
+                        engines=engines,
+                        qa_jobs=args.qa_jobs,
+                        qa_threads=args.qa_threads,
+                        passages=args.qa_passages,
+                        qa_timeout=args.qa_timeout,
                     )
                     # Run tests
                     print("Run tests with all gold input")
@@ -276,16 +743,18 @@ if __name__ == "__main__":
 
                 elif result == "1":
                     qu_input = args.input
-                    questions_df = pd.read_csv(qu_input, sep=",", header=0)
                     # run with user input
-                    question_understanding.ask_and_receive(
-                        questions_df=questions_df,
+                    run_batch_qu(
+                        qu_input,
+                        ir_input_generated,
+                        args,
                         device=device,
                         tokenizer=tokenizer,
                         model=model,
                         nlp=nlp,
-                        batch_mode=True,
-                        output_file=ir_input_generated,
+                        cache=cache,
+                        cascade=cascade,
+                        synonym_table=synonym_table,
                     )
                     raw_test_results = analysis.run_qu_tests(
                         gold_dataset_path=golden_dataset_path,
@@ -314,6 +783,11 @@ if __name__ == "__main__":
                             output_file=ir_output_generated,
                             indexer=pubmed_article_ix,
                             parser=qp,
+                            passage_indexer=pubmed_passage_ix,
+                            time_budget=args.time_budget,
+                            query_mode=args.query_mode,
+                            min_should_match=args.min_should_match,
+                            fields=("pmid",) if args.ir_pmids_only else None,
                         )
                         raw_test_results = analysis.run_ir_tests(
                             gold_dataset_path=golden_dataset_path,
@@ -345,6 +819,11 @@ if __name__ == "__main__":
                         question_answering.run_batch_mode(
                             input_file=ir_output_generated,
                             output_dir=qa_output_generated_dir,
+                            engines=engines,
+                            qa_jobs=args.qa_jobs,
+                            qa_threads=args.qa_threads,
+                            passages=args.qa_passages,
+                            qa_timeout=args.qa_timeout,
                         )
 
                         raw_test_results = analysis.run_qa_tests(
@@ -382,16 +861,18 @@ if __name__ == "__main__":
                         )
                 elif result == "4":
                     qu_input = args.input
-                    questions_df = pd.read_csv(qu_input, sep=",", header=0)
                     # run with user input
-                    question_understanding.ask_and_receive(
-                        questions_df=questions_df,
+                    run_batch_qu(
+                        qu_input,
+                        ir_input_generated,
+                        args,
                         device=device,
                         tokenizer=tokenizer,
                         model=model,
                         nlp=nlp,
-                        batch_mode=True,
-                        output_file=ir_input_generated,
+                        cache=cache,
+                        cascade=cascade,
+                        synonym_table=synonym_table,
                     )
                     raw_test_results = analysis.run_qu_tests(
                         gold_dataset_path=golden_dataset_path,
@@ -416,6 +897,11 @@ if __name__ == "__main__":
                         output_file=ir_output_generated,
                         indexer=pubmed_article_ix,
                         parser=qp,
+                        passage_indexer=pubmed_passage_ix,
+                        time_budget=args.time_budget,
+                        query_mode=args.query_mode,
+                        min_should_match=args.min_should_match,
+                        fields=("pmid",) if args.ir_pmids_only else None,
                     )
 
                     raw_test_results = analysis.run_ir_tests(
@@ -445,6 +931,10 @@ if __name__ == "__main__":
                             output_file=ir_output_generated,
                             indexer=pubmed_article_ix,
                             parser=qp,
+                            passage_indexer=pubmed_passage_ix,
+                            time_budget=args.time_budget,
+                            query_mode=args.query_mode,
+                            min_should_match=args.min_should_match,
                         )
                         raw_test_results = analysis.run_ir_tests(
                             gold_dataset_path=golden_dataset_path,
@@ -469,6 +959,11 @@ if __name__ == "__main__":
                         question_answering.run_batch_mode(
                             input_file=ir_output_generated,
                             output_dir=qa_output_generated_dir,
+                            engines=engines,
+                            qa_jobs=args.qa_jobs,
+                            qa_threads=args.qa_threads,
+                            passages=args.qa_passages,
+                            qa_timeout=args.qa_timeout,
                         )
 
                         raw_test_results = analysis.run_qa_tests(
@@ -490,41 +985,16 @@ if __name__ == "__main__":
     # If the user responds with anything not affirmative, send them to the live question answering
     else:
         #LOAD ALL THE MODELS
-
-        # This is for cpu support for non-NVIDEA cuda-capable machines.
-        spacy.prefer_gpu()
-        # initialize model
-        print(f"{MAGENTA}Initializing model...{OFF}")
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        model = BertForSequenceClassification.from_pretrained(
-            data_folder + os.path.sep + model_folder_name, cache_dir=None
-        )
-        
-        # load in BioBERT
-        print(f"{MAGENTA}Loading BioBERT...{OFF}")
-        nlp = en_core_sci_lg.load()
-        
-        # load index
-        index_var = "full_index"
-        print(f"{MAGENTA}Loading index...{OFF}")
-        
-        # This is the schema for each query retrieved from Pubmed
-        pubmed_article_ix = index.open_dir(
-            data_folder + os.path.sep + index_folder_name + os.path.sep + index_var,
-            indexname=pubmed_official_index_name,
-        )
-        qp = QueryParser(
-            "abstract_text",
-            schema=Schema(
-                pmid=ID(stored=True),
-                title=TEXT(stored=True),
-                journal=TEXT(stored=True),
-                mesh_major=IDLIST(stored=True),
-                year=NUMERIC(stored=True),
-                abstract_text=TEXT(stored=True, analyzer=StemmingAnalyzer()),
-            ),
+        # the loads run in the background while the user types their first question
+        loader = StartupLoader(max_workers=5)
+        loader.submit("QU model", load_qu, args, model_path, loader.submit("scispaCy", load_nlp))
+        loader.submit("index", load_index, index_path, pubmed_official_index_name, pubmed_passage_index_name)
+        loader.submit("pandas", importlib.import_module, "pandas")
+        loader.submit(
+            "QA models", load_qa_engines, args.qa_backend, args.qa_server_url, args.qa_threads,
+            args.qa_merged_checkpoint, args.qa_saved_model_dir, args.qa_torch_model_dir,
         )
+        print(f"{MAGENTA}Ready for questions {time.perf_counter() - loader.start:.2f}s after startup, models keep loading in the background{OFF}")
         n = 0
         while True:
             user_question = input(
@@ -535,6 +1005,14 @@ if __name__ == "__main__":
                 print(f"{MAGENTA}Shutting down...{OFF}")
                 clean_qa()
                 quit()
+            # block on the loads this question needs, only the first question can wait on them
+            pd = loader.get("pandas")
+            device, tokenizer, model, cache, cascade, synonym_table = loader.get("QU model")
+            nlp = loader.get("scispaCy")
+            import document_processing.information_retrieval as information_retrieval
+            pubmed_article_ix, pubmed_passage_ix, qp = loader.get("index")
+            if n == 0:
+                loader.report()
             df = pd.DataFrame({"ID": [n], "Question": user_question})
             # Retrieve the id,type, concepts, and query generated by QU module
             qu_output = question_understanding.ask_and_receive(
@@ -543,6 +1021,10 @@ if __name__ == "__main__":
                 tokenizer=tokenizer,
                 model=model,
                 nlp=nlp,
+                cache=cache,
+                cascade=cascade,
+                synonyms=synonym_table,
+                batch_size=args.qu_batch_size,
             )
             id, question, type, concepts, query = qu_output
             if type == "summary":
@@ -554,17 +1036,26 @@ if __name__ == "__main__":
                     f"{MAGENTA} <QU>\nID: {id}\nQuestion: {question}\nType: {type}\nConcepts:{concepts}\nQuery: {query}\n</QU> {OFF}"
                 )
                 query_results = information_retrieval.search(
-                    pubmed_article_ix, qp, qu_output
+                    pubmed_article_ix,
+                    qp,
+                    qu_output,
+                    time_budget=args.time_budget,
+                    query_mode=args.query_mode,
+                    min_should_match=args.min_should_match,
+                )
+                print(
+                    f"{MAGENTA}{len(query_results)} results in {1000 * query_results.elapsed:.1f} ms{OFF}"
                 )
                 if query_results:
                     top_result = query_results[0]
                     print(f"{MAGENTA} Top result\n{top_result}{OFF}")
-                    # Pass in the question ID, type, user question, and top abstract for the result
-                    data_for_qa = (n, type, user_question, top_result.abstract_text)
+                    # Pass in the question ID, type, user question, and the top abstracts for the result
+                    abstracts = [result.abstract_text for result in query_results[:args.qa_passages]]
+                    data_for_qa = (n, type, user_question, abstracts)
                     # all temporary data will be stored in tmp/live_qa/
                     qa_output_generated_dir = f"{os.getcwd()}{os.path.sep}tmp{os.path.sep}live_qa{os.path.sep}"
                     results = question_answering.get_answer(
-                        data_for_qa, output_dir=qa_output_generated_dir
+                        data_for_qa, output_dir=qa_output_generated_dir, engines=loader.get("QA models")
                     )
                     if results:
                         if type == "list":
@@ -0,0 +1,88 @@
+"""
+qu_cache.py :
+    A persistent SQLite cache of Question Understanding results (question type, entities, query).
+    Questions are keyed by a hash of their normalized text together with a stamp of the models that produced
+    the result, so retraining or re-exporting the QU model or upgrading scispaCy never serves stale results.
+"""
+from utils import *
+import hashlib
+import json
+import os
+import sqlite3
+
+
+# Questions that only differ in case or whitespace share an entry
+def normalize_question(question):
+    return " ".join(str(question).lower().split())
+
+
+def question_key(question):
+    return hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+
+
+# Stamp the model in model_dir by the name, size and modification time of the files it is loaded from.
+# Only those files are stamped, so writing other files to the folder (an ONNX export, a trained cascade) keeps
+# the cache. Missing files are stamped as missing. mode separates results of differently run models
+# (e.g. fp32 vs int8) and the versions of the other models QU runs (scispaCy).
+def model_version(model_dir, files, mode=""):
+    digest = hashlib.sha1(mode.encode("utf-8"))
+    for name in sorted(files):
+        path = os.path.join(model_dir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+        else:
+            digest.update(f"{name}:missing;".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class QUCache:
+
+    def __init__(self, path, version):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.version = version
+        # loaded in a background thread by qa_system.py and then used from the main thread, never concurrently
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS qu_results ("
+            "key TEXT NOT NULL, version TEXT NOT NULL, type TEXT, entities TEXT, query TEXT, "
+            "PRIMARY KEY (key, version))"
+        )
+        self.connection.commit()
+        self.lookups = 0
+        self.hits = 0
+
+    # Returns a (type, entities, query) tuple per question, None where the question is not cached
+    def get_many(self, questions):
+        results = []
+        for question in questions:
+            row = self.connection.execute(
+                "SELECT type, entities, query FROM qu_results WHERE key = ? AND version = ?",
+                (question_key(question), self.version),
+            ).fetchone()
+            results.append(None if row is None else (row[0], json.loads(row[1]), row[2]))
+        hits = sum(1 for result in results if result is not None)
+        self.lookups += len(results)
+        self.hits += hits
+        return results
+
+    # entries is an iterable of (question, type, entities, query)
+    def put_many(self, entries):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO qu_results (key, version, type, entities, query) VALUES (?, ?, ?, ?, ?)",
+            [
+                (question_key(question), self.version, qtype, json.dumps(list(entities)), query)
+                for question, qtype, entities, query in entries
+            ],
+        )
+        self.connection.commit()
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def report(self):
+        print(f"{MAGENTA}QU cache: {self.hits}/{self.lookups} hits ({self.hit_rate():.1%}){OFF}")
+
+    def close(self):
+        self.connection.close()
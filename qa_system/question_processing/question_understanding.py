@@ -7,107 +7,290 @@ question_understanding.py :
     for use in the Information Retrieval portion of the pipeline.
 """
 from utils import *
+from question_processing.synonyms import build_query
 import os
-import torch
+import time
+import numpy as np
 from lxml import etree as ET
 
 #map the original question to tokens utilizing a tokenizer
+#the whole batch is encoded in a single call, which a fast (Rust-backed) tokenizer runs in parallel
 def preprocess(df, tokenizer):
-    df.encoded_tokens = [tokenizer.encode_plus(text,add_special_tokens=True)['input_ids'] for text in df['Question']] 
-    df.attention_mask = [tokenizer.encode_plus(text,add_special_tokens=True)['attention_mask'] for text in df['Question']]
-    encoded_tokens = list(df.encoded_tokens)
-    attention_mask = list(df.attention_mask)
-    
+    encoded = tokenizer(list(df['Question']), add_special_tokens=True)
+    encoded_tokens = encoded['input_ids']
+    attention_mask = encoded['attention_mask']
+
     return encoded_tokens,attention_mask
 
-# Convert indices to Torch tensor and dump into cuda
-def feed_generator(device, encoded_tokens,attention_mask):
-    batch_size = 16
-    batch_seq = [x for x in range(int(len(encoded_tokens)/batch_size))]
-    shuffled_encoded_tokens,shuffled_attention_mask = encoded_tokens,attention_mask
-    res = len(encoded_tokens)%batch_size
-    if res != 0:
-        batch_seq = [x for x in range(int(len(encoded_tokens)/batch_size)+1)]
-    shuffled_encoded_tokens = shuffled_encoded_tokens+shuffled_encoded_tokens[:res]
-    shuffled_attention_mask = shuffled_attention_mask+shuffled_attention_mask[:res]
-
-    for batch in batch_seq:
-        maxlen_sent = max([len(i) for i in shuffled_encoded_tokens[batch*batch_size:(batch+1)*batch_size]])
-        token_tensor = torch.tensor([tokens+[0]*(maxlen_sent-len(tokens)) for tokens in shuffled_encoded_tokens[batch*batch_size:(batch+1)*batch_size]])
-        attention_mask = torch.tensor([tokens+[0]*(maxlen_sent-len(tokens)) for tokens in shuffled_attention_mask[batch*batch_size:(batch+1)*batch_size]])        
-        token_tensor = token_tensor.to('cpu')
-        attention_mask = attention_mask.to('cpu')
-        yield token_tensor,attention_mask
+# Questions are batched by length so each batch pads to a similar length.
+# With a fixed batch_size every batch has that many questions, with batch_size=None the size is tuned per batch
+# so that (questions in batch) * (longest question) stays under max_batch_tokens.
+DEFAULT_BATCH_SIZE = None
+MAX_BATCH_TOKENS = 2048
+
+# Group question indices into length-sorted batches, returns a list of lists of indices into encoded_tokens
+def length_buckets(encoded_tokens, batch_size=DEFAULT_BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS):
+    order = sorted(range(len(encoded_tokens)), key=lambda i: len(encoded_tokens[i]))
+    batches = []
+    batch = []
+    for i in order:
+        # order is ascending, so the current question is the longest one in the batch
+        if batch_size:
+            full = len(batch) == batch_size
+        else:
+            full = batch and (len(batch) + 1) * len(encoded_tokens[i]) > max_batch_tokens
+        if full:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Pad each batch into int64 arrays, which both the torch and the ONNX Runtime models take
+# yields each batch with the indices of its questions so predictions can be put back in input order
+def feed_generator(device, encoded_tokens,attention_mask, batch_size=DEFAULT_BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS):
+    for batch in length_buckets(encoded_tokens, batch_size, max_batch_tokens):
+        maxlen_sent = max([len(encoded_tokens[i]) for i in batch])
+        token_array = np.zeros((len(batch), maxlen_sent), dtype=np.int64)
+        mask_array = np.zeros((len(batch), maxlen_sent), dtype=np.int64)
+        for row, i in enumerate(batch):
+            token_array[row, :len(encoded_tokens[i])] = encoded_tokens[i]
+            mask_array[row, :len(attention_mask[i])] = attention_mask[i]
+        yield token_array,mask_array,batch
 
 # Returns a prediction ( query, snippets, features)
+# predictions are returned in the original question order
+# model is either a torch BertForSequenceClassification or an OnnxQuestionClassifier
 def predict(device, model,data):
+    if isinstance(model, OnnxQuestionClassifier):
+        return predict_onnx(model, data)
+    import torch
     model.eval()
     if device =="cuda:0":
         model.cuda()
-    preds = []
-    for token_tensor, attention_mask in data:
+    preds = {}
+    for token_array, mask_array, indices in data:
+        token_tensor = torch.from_numpy(token_array).to('cpu')
+        attention_mask = torch.from_numpy(mask_array).to('cpu')
         with torch.no_grad():
             logits = model(token_tensor,token_type_ids=None,attention_mask=attention_mask)[0]
             tmp_preds = torch.argmax(logits,-1).detach().cpu().numpy().tolist()
-        preds += tmp_preds             
-    return preds
+        for i, pred in zip(indices, tmp_preds):
+            preds[i] = pred
+    return [preds[i] for i in range(len(preds))]
+
+def predict_onnx(model, data):
+    preds = {}
+    for token_array, mask_array, indices in data:
+        logits = model(token_array, mask_array)
+        for i, pred in zip(indices, np.argmax(logits, -1).tolist()):
+            preds[i] = pred
+    return [preds[i] for i in range(len(preds))]
+
+ONNX_MODEL_NAME = "qu_model.onnx"
+
+# Export the QU classifier to ONNX with dynamic batch and sequence axes, so it can be served by ONNX Runtime
+# without loading torch or transformers. opset 13 is the newest the pinned torch 1.8 exporter supports
+def export_onnx(model, tokenizer, output_path, opset=13):
+    import torch
+    model.eval()
+    model.to('cpu')
+    sample = tokenizer(["Does metformin interfere thyroxine absorption?"], return_tensors="pt")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample['input_ids'], sample['attention_mask']),
+            output_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['logits'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'logits': {0: 'batch'},
+            },
+            opset_version=opset,
+        )
+    print(f"{MAGENTA}Exported QU model to {output_path}{OFF}")
+
+# The QU classifier running under ONNX Runtime on cpu
+# intra_op_threads parallelises inside an operator, inter_op_threads across independent operators (0 lets ONNX Runtime choose)
+class OnnxQuestionClassifier:
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, input_ids, attention_mask):
+        return self.session.run(['logits'], {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+
+# Returns an OnnxQuestionClassifier for model_dir/qu_model.onnx, or None if it has not been exported so the caller
+# can fall back to the torch model
+def load_onnx_classifier(model_dir, intra_op_threads=0, inter_op_threads=0):
+    path = os.path.join(model_dir, ONNX_MODEL_NAME)
+    if not os.path.exists(path):
+        return None
+    return OnnxQuestionClassifier(path, intra_op_threads, inter_op_threads)
+
+# Dynamic int8 quantization of the Linear layers for CPU-only hosts.
+# Weights are stored as int8 and activations are quantized on the fly, the quantized model only runs on cpu.
+def quantize_model(model):
+    import torch
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+# Compare the quantized model against the fp32 model on a labeled question set (the gold df 'body' and 'type' columns)
+# Reports the accuracy of both models against the gold types, how often they agree and the latency of each.
+def check_quantized(gold_df, tokenizer, model, quantized_model, batch_size=DEFAULT_BATCH_SIZE):
+    import torch
+    device = torch.device("cpu")
+    label_to_index = {'factoid': 0, 'list': 1, 'summary': 2, 'yesno': 3}
+    questions_df = gold_df.rename(columns={'body': 'Question'})
+    gold = [label_to_index.get(label) for label in questions_df['type']]
+    encoded_tokens, attention_mask = preprocess(questions_df, tokenizer)
+    results = {}
+    for name, qu_model in (('fp32', model.to(device)), ('int8', quantized_model)):
+        start = time.perf_counter()
+        preds = predict(device, qu_model, feed_generator(device, encoded_tokens, attention_mask, batch_size=batch_size))
+        elapsed = time.perf_counter() - start
+        correct = sum(1 for p, g in zip(preds, gold) if p == g)
+        results[name] = {'preds': preds, 'accuracy': correct / len(gold), 'seconds': elapsed}
+        print(f"{MAGENTA}{name}: accuracy {results[name]['accuracy']:.4f} on {len(gold)} questions in {elapsed:.2f}s ({1000 * elapsed / len(gold):.2f} ms/question){OFF}")
+    agreement = sum(1 for a, b in zip(results['fp32']['preds'], results['int8']['preds']) if a == b) / len(gold)
+    speedup = results['fp32']['seconds'] / results['int8']['seconds']
+    print(f"{MAGENTA}int8 agrees with fp32 on {agreement:.2%} of questions, accuracy change {results['int8']['accuracy'] - results['fp32']['accuracy']:+.4f}, speedup {speedup:.2f}x{OFF}")
+    return {'fp32_accuracy': results['fp32']['accuracy'], 'int8_accuracy': results['int8']['accuracy'],
+            'agreement': agreement, 'fp32_seconds': results['fp32']['seconds'],
+            'int8_seconds': results['int8']['seconds'], 'speedup': speedup}
+
+# Only doc.ents is read, so every other component of the scispaCy pipeline is disabled while extracting entities
+NER_COMPONENTS = ("tok2vec", "ner")
+NER_BATCH_SIZE = 64
+
+# Extract the entities of all the questions in one pass with nlp.pipe, n_process > 1 spreads the batches over cores.
+# Returns a list of entity string lists in question order.
+def extract_entities(questions, nlp, batch_size=NER_BATCH_SIZE, n_process=1):
+    disable = [name for name in nlp.pipe_names if name not in NER_COMPONENTS]
+    docs = nlp.pipe(questions, batch_size=batch_size, n_process=n_process, disable=disable)
+    return [[str(ent) for ent in doc.ents] for doc in docs]
+
+# Predict the type label of every question in questions_df
+# With a TypeCascade the questions it is confident about skip BERT and only the rest are escalated to the model
+def classify(questions_df, device, tokenizer, model, batch_size=DEFAULT_BATCH_SIZE, cascade=None):
+    start = time.perf_counter()
+    if cascade is not None:
+        predict_label = cascade.predict(list(questions_df['Question']))
+    else:
+        predict_label = [None] * len(questions_df)
+    escalated = [i for i, label in enumerate(predict_label) if label is None]
+    if escalated:
+        escalated_df = questions_df.iloc[escalated]
+        encoded_tokens_Test,attention_mask_Test = preprocess(escalated_df,tokenizer)
+        data_test = feed_generator(device, encoded_tokens_Test, attention_mask_Test, batch_size=batch_size)
+        preds_test = predict(device,model,data_test)
+        indices_to_label = {0: 'factoid', 1: 'list', 2: 'summary', 3: 'yesno'}
+        for i, pred in zip(escalated, preds_test):
+            predict_label[i] = indices_to_label[pred]
+    elapsed = time.perf_counter() - start
+    print(f"{MAGENTA}Typed {len(predict_label)} questions in {elapsed:.2f}s ({len(predict_label) / elapsed:.1f} questions/s){OFF}")
+    if cascade is not None:
+        cascade.report()
+    return predict_label
+
+# Fill in the 'type', 'entities' and 'query' columns of questions_df
+# With a SynonymTable the query entities are expanded with their UMLS synonyms
+# With a QUCache only the questions that are not cached yet go through the type classifier and scispaCy
+def understand(questions_df, device, tokenizer, model, nlp, batch_size=DEFAULT_BATCH_SIZE, ner_batch_size=NER_BATCH_SIZE, n_process=1, cache=None, cascade=None, synonyms=None):
+    questions = list(questions_df['Question'])
+    results = cache.get_many(questions) if cache is not None else [None] * len(questions)
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        miss_df = questions_df.iloc[misses]
+        types = classify(miss_df, device, tokenizer, model, batch_size, cascade)
+        entities = extract_entities(list(miss_df['Question']), nlp, ner_batch_size, n_process)
+        for i, qtype, ents in zip(misses, types, entities):
+            results[i] = (qtype, ents, build_query(ents, synonyms))
+        if cache is not None:
+            cache.put_many((questions[i],) + results[i] for i in misses)
+    if cache is not None:
+        cache.report()
+    questions_df['type'] = [result[0] for result in results]
+    questions_df['entities'] = [result[1] for result in results]
+    questions_df['query'] = [result[2] for result in results]
+    return questions_df
 
 # If we are in batch mode, append all generated queries and concepts to xml file,
 # Otherwise pass QU data (question type, concepts, query) back for transfer to IR module
-def ask_and_receive(questions_df, device, tokenizer, model, nlp , batch_mode = False, output_file=None):
-    encoded_tokens_Test,attention_mask_Test = preprocess(questions_df,tokenizer)
-    data_test = feed_generator(device, encoded_tokens_Test, attention_mask_Test)
-    preds_test = predict(device,model,data_test)
-    indices_to_label = {0: 'factoid', 1: 'list', 2: 'summary', 3: 'yesno'}
-    predict_label = []
-    for i in preds_test[0:len(questions_df['Question'])]:
-        for j in indices_to_label:
-            if i == j:
-                predict_label.append(indices_to_label[j])
-    questions_df['type'] = predict_label
+def ask_and_receive(questions_df, device, tokenizer, model, nlp , batch_mode = False, output_file=None, batch_size=DEFAULT_BATCH_SIZE, ner_batch_size=NER_BATCH_SIZE, n_process=1, cache=None, cascade=None, synonyms=None):
+    understand(questions_df, device, tokenizer, model, nlp, batch_size, ner_batch_size, n_process, cache, cascade, synonyms)
     if(batch_mode):
         print(f"{MAGENTA}Writing QU results to xml file...{OFF}")
-        xml_tree(questions_df,nlp,output_file)
+        xml_tree(questions_df,output_file)
     else:
-        return send_qu_data(questions_df,nlp)
+        return send_qu_data(questions_df)
+
+DEFAULT_CHUNKSIZE = 1000
+
+# Streaming batch mode for question CSVs of any size: the CSV is read chunksize questions at a time and each
+# chunk's <Q> elements are appended to output_file and flushed before the next chunk is read, so memory stays
+# bounded by the chunk size. information_retrieval.batch_search reads the file back one <Q> at a time.
+def ask_and_receive_stream(input_file, output_file, device, tokenizer, model, nlp, chunksize=DEFAULT_CHUNKSIZE, batch_size=DEFAULT_BATCH_SIZE, ner_batch_size=NER_BATCH_SIZE, n_process=1, cache=None, cascade=None, synonyms=None):
+    import pandas as pd
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    start = time.perf_counter()
+    written = 0
+    with ET.xmlfile(output_file, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element("Input"):
+            for chunk in pd.read_csv(input_file, sep=",", header=0, chunksize=chunksize):
+                understand(chunk, device, tokenizer, model, nlp, batch_size, ner_batch_size, n_process, cache, cascade, synonyms)
+                for ind in chunk.index:
+                    xf.write(build_q_element(chunk['ID'][ind], chunk['Question'][ind], chunk['type'][ind],
+                                             chunk['entities'][ind], chunk['query'][ind]), pretty_print=True)
+                xf.flush()
+                written += len(chunk)
+                print(f"{MAGENTA}Wrote {written} questions to {output_file} ({time.perf_counter() - start:.1f}s){OFF}")
 
 #instead of using the xml, just pass the data
-def send_qu_data(df,nlp):
+def send_qu_data(df):
     ind = df.first_valid_index()
     id = df['ID'][ind]
     question = df['Question'][ind]
     type = df['type'][ind]
-    doc = nlp(question)
-    entities = []
-    for ent in doc.ents:
-        entities.append(str(ent))
-    query = str(' '.join(entities))
+    entities = df['entities'][ind]
+    query = df['query'][ind]
     return (id, question, type, entities, query)
 
+# Build the <Q> element holding a question and its QU results, with an empty <IR> tag for the IR module to fill
+def build_q_element(id, question, qtype, entities, query):
+    q = ET.Element("Q")
+    q.set('id',str(id))
+    q.text = question
+    qp = ET.SubElement(q,"QP")
+    qp_type = ET.SubElement(qp,'Type')
+    qp_type.text = qtype
+    for ent in entities:
+        qp_en = ET.SubElement(qp,'Entities') 
+        qp_en.text = ent
+    qp_query = ET.SubElement(qp,'Query')
+    qp_query.text = query
+    # Create IR tag
+    IR = ET.SubElement(q, "IR")
+    return q
+
 # Print the extracted information from BioBERT to an xml file we will append to later.
-def xml_tree(df,nlp,output_file):
+def xml_tree(df,output_file):
     root = ET.Element("Input")
     for ind in df.index:
-        id = df['ID'][ind]
-        question = df['Question'][ind]
-        qtype = df['type'][ind]
-        q = ET.SubElement(root,"Q")
-        q.set('id',str(id))
-        q.text = question
-        qp = ET.SubElement(q,"QP")
-        qp_type = ET.SubElement(qp,'Type')
-        qp_type.text = qtype
-        doc = nlp(question)
-        print(f"{MAGENTA}doc: {doc.ents}{OFF}")
-        ent_list = []
-        for ent in doc.ents:
-            ent_list.append(str(ent))
-            qp_en = ET.SubElement(qp,'Entities') 
-            qp_en.text = str(ent)
-        qp_query = ET.SubElement(qp,'Query')
-        qp_query.text = str(' '.join(ent_list))
-        # Create IR tag
-        IR = ET.SubElement(q, "IR")
+        entities = df['entities'][ind]
+        print(f"{MAGENTA}doc: {entities}{OFF}")
+        root.append(build_q_element(df['ID'][ind], df['Question'][ind], df['type'][ind], entities, df['query'][ind]))
     tree = ET.ElementTree(root)
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     tree.write(output_file, pretty_print=True)
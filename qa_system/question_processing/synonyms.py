@@ -0,0 +1,182 @@
+"""
+synonyms.py :
+    A precompiled, memory mapped UMLS synonym table used by QU to expand query entities.
+
+    The table is compiled offline from MRCONSO.RRF:
+        python3 question_processing/synonyms.py <path_to_MRCONSO.RRF> data_modules/synonyms.bin
+    Every English surface form of a concept is hashed and the sorted hashes point at one record per concept holding
+    its preferred term followed by its synonyms, so a lookup at query time is a binary search over the mapped file.
+"""
+import argparse
+import bisect
+import hashlib
+import mmap
+import struct
+from array import array
+
+# MRCONSO.RRF columns
+CUI, LAT, TS, STT, ISPREF, SAB, STR, SUPPRESS = 0, 1, 2, 4, 6, 11, 14, 16
+
+# file layout: a header (magic, n), n sorted uint64 surface form hashes, the n uint32 record offsets and
+#   the n uint32 record lengths into the data block that follows, records are utf-8 terms separated by SEPARATOR
+MAGIC = b"QUSYN001"
+HEADER_FORMAT = "<8sQ"
+SEPARATOR = "\x1f"
+DEFAULT_SOURCES = ("MSH",)
+MAX_TERMS_PER_CONCEPT = 16
+DEFAULT_MAX_SYNONYMS = 3
+DEFAULT_MAX_QUERY_SYNONYMS = 12
+
+
+def normalize(term):
+    return " ".join(term.lower().split())
+
+
+def term_hash(term):
+    return struct.unpack("<Q", hashlib.blake2b(normalize(term).encode("utf-8"), digest_size=8).digest())[0]
+
+
+# Compile MRCONSO.RRF into the lookup table at output_path
+# Only English, unsuppressed strings from the given sources (None for all of them) are kept
+def compile_table(mrconso_path, output_path, sources=DEFAULT_SOURCES, max_terms=MAX_TERMS_PER_CONCEPT):
+    concepts = {}
+    preferred = {}
+    with open(mrconso_path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("|")
+            if fields[LAT] != "ENG" or fields[SUPPRESS] != "N":
+                continue
+            if sources and fields[SAB] not in sources:
+                continue
+            cui = fields[CUI]
+            term = normalize(fields[STR])
+            terms = concepts.setdefault(cui, {})
+            terms.setdefault(term, fields[STR].strip())
+            if fields[TS] == "P" and fields[STT] == "PF" and fields[ISPREF] == "Y" and cui not in preferred:
+                preferred[cui] = term
+
+    data = bytearray()
+    entries = {}
+    for cui, terms in concepts.items():
+        head = preferred.get(cui, next(iter(terms)))
+        ordered = [terms[head]] + [text for term, text in terms.items() if term != head][:max_terms - 1]
+        record = SEPARATOR.join(ordered).encode("utf-8")
+        offset = len(data)
+        data += record
+        for term in terms:
+            # a surface form shared by several concepts keeps the concept it is the preferred term of,
+            # otherwise the first concept it was seen in
+            h = term_hash(term)
+            if h not in entries or term == head:
+                entries[h] = (offset, len(record))
+
+    hashes = array("Q", sorted(entries))
+    offsets = array("I", (entries[h][0] for h in hashes))
+    lengths = array("I", (entries[h][1] for h in hashes))
+    with open(output_path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, len(hashes)))
+        hashes.tofile(f)
+        offsets.tofile(f)
+        lengths.tofile(f)
+        f.write(data)
+    print(f"compiled {len(concepts)} concepts and {len(hashes)} surface forms into {output_path}")
+
+
+class SynonymTable:
+
+    # max_synonyms caps the synonyms added per entity and max_query_synonyms the synonyms added per query
+    def __init__(self, path, max_synonyms=DEFAULT_MAX_SYNONYMS, max_query_synonyms=DEFAULT_MAX_QUERY_SYNONYMS):
+        self.path = path
+        self.max_synonyms = max_synonyms
+        self.max_query_synonyms = max_query_synonyms
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = struct.unpack_from(HEADER_FORMAT, self.buffer)
+        assert magic == MAGIC, "not a synonym table " + path
+        start = struct.calcsize(HEADER_FORMAT)
+        self.view = memoryview(self.buffer)
+        self.hashes = self.view[start:start + 8 * size].cast("Q")
+        start += 8 * size
+        self.offsets = self.view[start:start + 4 * size].cast("I")
+        start += 4 * size
+        self.lengths = self.view[start:start + 4 * size].cast("I")
+        self.data_start = start + 4 * size
+
+    # Returns [preferred term, synonyms...] for a surface form, or an empty list if it is not in the table
+    def lookup(self, term):
+        h = term_hash(term)
+        i = bisect.bisect_left(self.hashes, h)
+        if i == len(self.hashes) or self.hashes[i] != h:
+            return []
+        start = self.data_start + self.offsets[i]
+        return bytes(self.view[start:start + self.lengths[i]]).decode("utf-8").split(SEPARATOR)
+
+    # At most max_synonyms terms for the entity, preferred term first, leaving out the entity itself
+    def expand(self, entity, max_synonyms=None):
+        if max_synonyms is None:
+            max_synonyms = self.max_synonyms
+        entity_key = normalize(entity)
+        expansions = []
+        for term in self.lookup(entity):
+            if len(expansions) == max_synonyms:
+                break
+            if normalize(term) != entity_key:
+                expansions.append(term)
+        return expansions
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def close(self):
+        for view in (self.hashes, self.offsets, self.lengths, self.view):
+            view.release()
+        self.buffer.close()
+        self.file.close()
+
+
+# Single quote every word of text, so the IR query parser reads each as a plain term rather than as field
+# (p53:MDM2), grouping, wildcard or operator syntax. Apostrophes would end the quote early and the analyzer
+# splits words on them anyway, so they become spaces.
+def quote_terms(text):
+    return " ".join(f"'{word}'" for word in text.replace("'", " ").split())
+
+
+# Build the IR query from the QU entities. Without a table this is the plain ' '.join(entities) query,
+# with one each expanded entity becomes (('entity' 'words') OR "synonym" ...) and no more than the table's
+# max_query_synonyms synonyms are added over the whole query so the search cost stays bounded
+def build_query(entities, table=None):
+    if table is None:
+        return str(' '.join(entities))
+    budget = table.max_query_synonyms
+    parts = []
+    for entity in entities:
+        expansions = table.expand(entity, min(table.max_synonyms, budget)) if budget > 0 else []
+        budget -= len(expansions)
+        if expansions:
+            alternatives = " OR ".join('"' + term.replace('"', '') + '"' for term in expansions)
+            parts.append(f"(({quote_terms(entity)}) OR {alternatives})")
+        else:
+            parts.append(entity)
+    return str(' '.join(parts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_mrconso", help="The filepath to the mrconso file (e.g. umls/MRCONSO.RRF)")
+    parser.add_argument("output", help="Where to write the synonym table (e.g. data_modules/synonyms.bin)")
+    parser.add_argument(
+        "-s",
+        "--sources",
+        nargs="*",
+        default=list(DEFAULT_SOURCES),
+        help="UMLS source vocabularies to keep, MeSH (MSH) by default. Pass no values to keep every source.",
+    )
+    parser.add_argument(
+        "-m",
+        "--max_terms",
+        type=int,
+        default=MAX_TERMS_PER_CONCEPT,
+        help="Maximum number of terms stored per concept",
+    )
+    args = parser.parse_args()
+    compile_table(args.path_to_mrconso, args.output, sources=set(args.sources), max_terms=args.max_terms)
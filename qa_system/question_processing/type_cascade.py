@@ -0,0 +1,85 @@
+"""
+type_cascade.py :
+    A cheap first stage for question type classification. First-word rules and a TF-IDF + logistic regression
+    model answer the questions they are confident about, the rest are escalated to the BERT classifier.
+"""
+from utils import *
+import os
+import re
+
+CASCADE_MODEL_NAME = "type_cascade.joblib"
+DEFAULT_THRESHOLD = 0.9
+
+# BioASQ questions that start like these are all but always of the given type
+FIRST_WORD_RULES = [
+    (re.compile(r"^(is|are|does|do|did|can|could|has|have|was|were|will|should)\b", re.IGNORECASE), "yesno"),
+    (re.compile(r"^list\b", re.IGNORECASE), "list"),
+    (re.compile(r"^(describe|summarize|explain)\b", re.IGNORECASE), "summary"),
+]
+
+
+def rule_type(question):
+    for pattern, qtype in FIRST_WORD_RULES:
+        if pattern.match(str(question).strip()):
+            return qtype
+    return None
+
+
+# Train the linear stage on the gold questions ('body') and types ('type') of the analysis gold df and save it
+def train(gold_df, output_path):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    import joblib
+
+    pipeline = make_pipeline(
+        TfidfVectorizer(lowercase=True, ngram_range=(1, 2), min_df=1, sublinear_tf=True),
+        LogisticRegression(max_iter=1000),
+    )
+    pipeline.fit(list(gold_df["body"]), list(gold_df["type"]))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    joblib.dump(pipeline, output_path)
+    print(f"{MAGENTA}Trained type cascade on {len(gold_df)} questions, saved to {output_path}{OFF}")
+    return pipeline
+
+
+class TypeCascade:
+
+    def __init__(self, pipeline=None, threshold=DEFAULT_THRESHOLD):
+        self.pipeline = pipeline
+        self.threshold = threshold
+        self.questions = 0
+        self.escalated = 0
+
+    # Returns the type of every question the cascade is confident about and None for the ones to escalate
+    def predict(self, questions):
+        labels = [rule_type(question) for question in questions]
+        undecided = [i for i, label in enumerate(labels) if label is None]
+        if undecided and self.pipeline is not None:
+            probabilities = self.pipeline.predict_proba([questions[i] for i in undecided])
+            classes = self.pipeline.classes_
+            for i, row in zip(undecided, probabilities):
+                best = row.argmax()
+                if row[best] >= self.threshold:
+                    labels[i] = classes[best]
+        self.questions += len(labels)
+        self.escalated += sum(1 for label in labels if label is None)
+        return labels
+
+    def escalation_rate(self):
+        return self.escalated / self.questions if self.questions else 0.0
+
+    def report(self):
+        print(f"{MAGENTA}Type cascade: escalated {self.escalated}/{self.questions} questions to BERT ({self.escalation_rate():.1%}){OFF}")
+
+
+# Load the cascade from model_dir, without a trained linear stage only the first-word rules are used
+def load_cascade(model_dir, threshold=DEFAULT_THRESHOLD):
+    path = os.path.join(model_dir, CASCADE_MODEL_NAME)
+    pipeline = None
+    if os.path.exists(path):
+        import joblib
+        pipeline = joblib.load(path)
+    else:
+        print(f"{YELLOW}No {CASCADE_MODEL_NAME} in {model_dir}, the type cascade only uses first-word rules{OFF}")
+    return TypeCascade(pipeline, threshold)
@@ -0,0 +1,113 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whoosh.fields import ID, STORED, TEXT, Schema
+from whoosh.filedb.filestore import RamStorage
+from whoosh.qparser import QueryParser
+
+import document_processing.information_retrieval as information_retrieval
+
+DOCUMENTS = [("1", "alpha beta gamma"), ("2", "alpha"), ("3", "alpha beta"), ("4", "beta gamma"), ("5", "delta")]
+
+
+def make_index():
+    schema = Schema(pmid=ID(stored=True), abstract_text=TEXT(stored=True), mesh_major=STORED)
+    ix = RamStorage().create_index(schema)
+    writer = ix.writer()
+    for pmid, text in DOCUMENTS:
+        writer.add_document(pmid=pmid, abstract_text=text, mesh_major=[])
+    writer.commit()
+    return ix, QueryParser("abstract_text", schema=schema)
+
+
+def search_pmids(min_should_match, time_budget=None):
+    ix, parser = make_index()
+    results = information_retrieval.search(
+        ix, parser, "alpha beta gamma", batch_mode=True, time_budget=time_budget, query_mode="or",
+        min_should_match=min_should_match, fields=("pmid",),
+    )
+    return sorted(result.pmid for result in results)
+
+
+def test_min_should_match_one_keeps_single_term_matches():
+    assert search_pmids(1) == ["1", "2", "3", "4"]
+
+
+def test_min_should_match_two_drops_single_term_matches():
+    assert search_pmids(2) == ["1", "3", "4"]
+    assert search_pmids(2, time_budget=5) == ["1", "3", "4"]
+
+
+def test_min_should_match_fraction_and_all_terms():
+    assert search_pmids(0.5) == ["1", "3", "4"]
+    assert search_pmids(3) == ["1"]
+
+
+def make_passage_index():
+    schema = Schema(pmid=ID(stored=True), section=ID(stored=True), offset=ID(stored=True),
+                    passage_text=TEXT(stored=True))
+    ix = RamStorage().create_index(schema)
+    writer = ix.writer()
+    for pmid, text in DOCUMENTS:
+        writer.add_document(pmid=pmid, section="abstract", offset="0", passage_text=text)
+    writer.commit()
+    return ix
+
+
+def test_search_passages_applies_time_budget_and_min_should_match():
+    ix, _ = make_index()
+    passage_ix = make_passage_index()
+    passages, articles = information_retrieval.search_passages(
+        ix, passage_ix, "alpha beta gamma", max_results=10, batch_mode=True, time_budget=5, query_mode="or",
+        min_should_match=2,
+    )
+    assert sorted(passage.pmid for passage in passages) == ["1", "3", "4"]
+    assert not passages.partial
+    assert sorted(article.pmid for article in articles) == ["1", "3", "4"]
+
+
+def test_batch_search_streams_every_question_to_the_output(tmp_path):
+    ix, parser = make_index()
+    input_file = str(tmp_path / "ir_input.xml")
+    output_file = str(tmp_path / "ir_output.xml")
+    with open(input_file, "w") as f:
+        f.write('<Input>\n'
+                '  <Q id="q1">Alpha?<QP><Type>factoid</Type><Query>alpha gamma</Query></QP><IR/></Q>\n'
+                '  <Q id="q2">Delta?<QP><Type>yesno</Type><Query>delta</Query></QP><IR/></Q>\n'
+                '</Input>\n')
+    information_retrieval.batch_search(input_file, output_file, ix, parser, write_buffer_size=1)
+    root = information_retrieval.ET.parse(output_file).getroot()
+    assert root.tag == "Input"
+    pmids = {q.get("id"): [result.get("PMID") for result in q.find("IR").iterfind("Result")] for q in root.iterfind("Q")}
+    assert pmids == {"q1": ["1"], "q2": ["5"]}
+    assert root.find("Q/IR/Result/Abstract").text == "alpha beta gamma"
+
+
+def test_get_by_pmid_reads_the_pubmed_indexer_pmid_table(tmp_path):
+    from PubmedArticle import PubmedArticle
+    indexer = information_retrieval.PubmedIndexer.PubmedIndexer()
+    indexer.mk_index(str(tmp_path), overwrite=True)
+    indexer.index_docs([PubmedArticle(pmid, f"Title {pmid}", "J", "2000", text, []) for pmid, text in DOCUMENTS])
+    articles = information_retrieval.get_by_pmid(indexer.pubmed_article_ix, ["3", "1", "42"])
+    assert {pmid: article.title for pmid, article in articles.items()} == {"3": "Title 3", "1": "Title 1"}
+
+
+def test_lazy_results_decode_each_hit_once_on_first_access(monkeypatch):
+    from whoosh.reading import SegmentReader
+    decoded = []
+    stored_fields = SegmentReader.stored_fields
+
+    def counting_stored_fields(self, docnum):
+        decoded.append(docnum)
+        return stored_fields(self, docnum)
+
+    ix, parser = make_index()
+    monkeypatch.setattr(SegmentReader, "stored_fields", counting_stored_fields)
+    results = information_retrieval.search(ix, parser, "alpha", batch_mode=True, fields=("pmid",))
+    assert decoded == []
+    assert sorted(result.pmid for result in results) == ["1", "2", "3"]
+    assert [result.abstract_text for result in results if result.pmid == "2"] == ["alpha"]
+    assert sorted(decoded) == sorted(set(decoded)) and len(decoded) == 3
+    results.close()
@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import answer_processing.qa_server as qa_server
+
+
+# answers every question with its (batch tagged) id after inference_ms, like a model whose cost does not grow with the batch
+class StubEngine:
+    question_type = "factoid"
+
+    def __init__(self, inference_ms=0):
+        self.inference_ms = inference_ms
+
+    def predict(self, json_data, output_dir=None):
+        time.sleep(self.inference_ms / 1000)
+        ids = [qa["id"] for entry in json_data["data"] for paragraph in entry["paragraphs"] for qa in paragraph["qas"]]
+        return {qas_id: qas_id for qas_id in ids}, None
+
+
+def squad(qas_id):
+    return {"data": [{"paragraphs": [{"context": "Some text.", "qas": [{"id": qas_id, "question": "What?"}]}]}]}
+
+
+def test_requests_queued_behind_a_running_batch_are_batched_together():
+    batcher = qa_server.MicroBatcher(StubEngine(inference_ms=200), max_wait_ms=10)
+    requests = {}
+
+    def submit(i):
+        requests[str(i)] = batcher.submit(squad(str(i)))
+
+    threads = []
+    for i in range(20):
+        thread = threading.Thread(target=submit, args=(i,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    assert all(set(request.predictions) == {qas_id} for qas_id, request in requests.items())
+    assert len(requests) == 20
+    assert max(request.batch_size for request in requests.values()) > 1
+
+
+def test_engine_errors_are_reported_and_the_worker_keeps_running():
+    batcher = qa_server.MicroBatcher(StubEngine(), max_wait_ms=1)
+    failed = batcher.submit({"nodata": 1})
+    assert failed.error is not None
+    answered = batcher.submit(squad("q1"))
+    assert answered.error is None and set(answered.predictions) == {"q1"}
+
+
+def test_post_with_the_wrong_shape_is_rejected():
+    qa_server.QARequestHandler.batchers = {"factoid": qa_server.MicroBatcher(StubEngine(), max_wait_ms=1)}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), qa_server.QARequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/predict/factoid"
+    try:
+        request = urllib.request.Request(url, data=json.dumps({"nodata": 1}).encode("utf-8"))
+        try:
+            urllib.request.urlopen(request, timeout=5)
+            assert False, "expected a 400 response"
+        except urllib.error.HTTPError as e:
+            assert e.code == 400
+        request = urllib.request.Request(url, data=json.dumps(squad("q1")).encode("utf-8"))
+        with urllib.request.urlopen(request, timeout=5) as response:
+            assert set(json.loads(response.read())["predictions"]) == {"q1"}
+    finally:
+        server.shutdown()
+        server.server_close()
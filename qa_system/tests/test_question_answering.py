@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import answer_processing.question_answering as question_answering
+
+
+# a stand-in runner script that ignores the runner flags it is called with
+def runner_script(tmp_path, body):
+    script = tmp_path / "runner.py"
+    script.write_text("import sys, time\n" + body)
+    return str(script)
+
+
+def test_failed_runs_report_the_tail_of_the_stderr_log(tmp_path):
+    script = runner_script(tmp_path, "for i in range(5000):\n    print('step', i, file=sys.stderr)\nsys.exit(3)\n")
+    output_dir = tmp_path / "out"
+    result = question_answering.run_qa_file(script, str(output_dir), "predict.json", "factoid")
+    assert result.status == "failed" and result.returncode == 3
+    assert result.error.endswith("step 4999\n") and len(result.error) <= 2000
+    log = (output_dir / question_answering.RUNNER_LOG_NAME).read_text()
+    assert log.startswith("step 0\n") and log.endswith("step 4999\n")
+
+
+def test_timed_out_runs_keep_what_was_logged(tmp_path):
+    script = runner_script(tmp_path, "print('loading', file=sys.stderr, flush=True)\ntime.sleep(30)\n")
+    result = question_answering.run_qa_file(script, str(tmp_path), "predict.json", "yesno", timeout=2)
+    assert result.status == "timeout"
+    assert result.error == "loading\n"
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "answer_processing"))
+
+import squad_utils
+import tokenization
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "what", "binds", "p53", "?", "mdm2", "to", "and", "is", "it"]
+
+
+def tokenizer(tmp_path):
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(VOCAB) + "\n")
+    return tokenization.FullTokenizer(vocab_file=str(vocab_file), do_lower_case=True)
+
+
+def features_for(tmp_path, yesno=False):
+    examples = [squad_utils.SquadExample(qas_id="q1", question_text="What binds p53?",
+                                         doc_tokens="MDM2 binds to p53".split())]
+    features = []
+    squad_utils.convert_examples_to_features(
+        examples, tokenizer(tmp_path), max_seq_length=16, doc_stride=8, max_query_length=8, is_training=False,
+        output_fn=features.append, yesno=yesno,
+    )
+    return examples, features
+
+
+def write_span(tmp_path, examples, features, **kwargs):
+    # the highest start and end logits point at "mdm2", the first context token after [CLS] q q q ? [SEP]
+    logits = [0.0] * 16
+    logits[6] = 5.0
+    results = [squad_utils.SpanRawResult(unique_id=features[0].unique_id, start_logits=logits, end_logits=logits)]
+    squad_utils.write_span_predictions(
+        examples, features, results, 20, 30, True, str(tmp_path / "predictions.json"),
+        str(tmp_path / "nbest_predictions.json"), str(tmp_path / "null_odds.json"), **kwargs
+    )
+    with open(tmp_path / "predictions.json") as f:
+        predictions = json.load(f)
+    with open(tmp_path / "nbest_predictions.json") as f:
+        nbest = json.load(f)
+    return predictions, nbest
+
+
+def test_span_predictions_are_projected_back_to_the_context(tmp_path):
+    examples, features = features_for(tmp_path)
+    assert features[0].tokens[:6] == ["[CLS]", "what", "binds", "p53", "?", "[SEP]"]
+    predictions, nbest = write_span(tmp_path, examples, features)
+    assert predictions == {"q1": "MDM2"}
+    assert "question_text" not in nbest["q1"][0]
+
+
+def test_list_nbest_keeps_the_question_text(tmp_path):
+    examples, features = features_for(tmp_path)
+    _, nbest = write_span(tmp_path, examples, features, with_question_text=True)
+    assert all(entry["question_text"] == "What binds p53?" for entry in nbest["q1"])
+
+
+def test_yesno_predictions_use_the_first_doc_span(tmp_path):
+    examples, features = features_for(tmp_path, yesno=True)
+    results = [squad_utils.YesNoRawResult(unique_id=features[0].unique_id, logits=[0.9])]
+    squad_utils.write_yesno_predictions(
+        examples, features, results, 20, 30, True, str(tmp_path / "predictions.json"), None, None
+    )
+    with open(tmp_path / "predictions.json") as f:
+        assert json.load(f) == {"q1": ["yes", [0.9]]}
+
+
+def test_runner_bundles_the_question_type_helpers(tmp_path):
+    examples, features = features_for(tmp_path)
+    results = [squad_utils.SpanRawResult(unique_id=features[0].unique_id, start_logits=[0.0] * 16,
+                                         end_logits=[0.0] * 16)]
+    squad_utils.runner("list").write_predictions(
+        examples, features, results, 20, 30, True, str(tmp_path / "predictions.json"),
+        str(tmp_path / "nbest_predictions.json"), str(tmp_path / "null_odds.json"),
+    )
+    with open(tmp_path / "nbest_predictions.json") as f:
+        assert "question_text" in json.load(f)["q1"][0]
+    assert squad_utils.runner("yesno").RawResult is squad_utils.YesNoRawResult
@@ -0,0 +1,46 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whoosh.analysis import StemmingAnalyzer
+from whoosh.fields import ID, TEXT, Schema
+from whoosh.qparser import QueryParser
+from whoosh.query import Or, Phrase, Term
+
+from question_processing.synonyms import build_query
+
+
+class StubTable:
+    max_synonyms = 3
+    max_query_synonyms = 12
+
+    def __init__(self, synonyms):
+        self.synonyms = synonyms
+
+    def expand(self, entity, max_synonyms):
+        return self.synonyms.get(entity, [])[:max_synonyms]
+
+
+def parse(query):
+    schema = Schema(pmid=ID(stored=True), title=TEXT(stored=True), abstract_text=TEXT(analyzer=StemmingAnalyzer()))
+    return QueryParser("abstract_text", schema=schema).parse(query)
+
+
+def test_expanded_entities_are_searched_as_plain_terms():
+    table = StubTable({"title:MDM2": ["mouse double minute 2"], "p53 (TP53": ["tumor protein p53"]})
+    for entity in ("title:MDM2", "p53 (TP53"):
+        q = parse(build_query([entity], table))
+        assert isinstance(q, Or) and isinstance(q.subqueries[1], Phrase)
+        terms = [term for term in q.subqueries[0].leaves() if isinstance(term, Term)]
+        assert terms and all(term.fieldname == "abstract_text" for term in terms)
+
+
+def test_apostrophes_do_not_drop_the_entity():
+    q = parse(build_query(["Alzheimer's disease"], StubTable({"Alzheimer's disease": ["presenile dementia"]})))
+    assert {term.text for term in q.subqueries[0].leaves()} == {"alzheim", "diseas"}
+
+
+def test_entities_without_synonyms_are_unchanged():
+    assert build_query(["p53", "MDM2"], StubTable({})) == "p53 MDM2"
+    assert build_query(["p53", "MDM2"]) == "p53 MDM2"
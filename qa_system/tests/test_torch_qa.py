@@ -0,0 +1,74 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+QA_SYSTEM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, QA_SYSTEM_DIR)
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from transformers import BertConfig
+
+import answer_processing.torch_qa as torch_qa
+
+BERT_DIR = os.path.join(QA_SYSTEM_DIR, "bert_models")
+# a one layer model is enough to check that every parameter gets exactly one checkpoint variable
+TINY_CONFIG = dict(vocab_size=16, hidden_size=8, num_hidden_layers=1, num_attention_heads=2, intermediate_size=16)
+LAYER_VARIABLES = [
+    "attention/self/query/kernel", "attention/self/query/bias", "attention/self/key/kernel",
+    "attention/self/key/bias", "attention/self/value/kernel", "attention/self/value/bias",
+    "attention/output/dense/kernel", "attention/output/dense/bias", "attention/output/LayerNorm/gamma",
+    "attention/output/LayerNorm/beta", "intermediate/dense/kernel", "intermediate/dense/bias",
+    "output/dense/kernel", "output/dense/bias", "output/LayerNorm/gamma", "output/LayerNorm/beta",
+]
+# the variables of a fine-tuned BioBERT checkpoint, with the optimizer slots and both question type heads
+TF_VARIABLES = (
+    ["bert/embeddings/word_embeddings", "bert/embeddings/position_embeddings",
+     "bert/embeddings/token_type_embeddings", "bert/embeddings/LayerNorm/gamma", "bert/embeddings/LayerNorm/beta"]
+    + ["bert/encoder/layer_0/" + name for name in LAYER_VARIABLES]
+    + ["bert/pooler/dense/kernel", "bert/pooler/dense/bias"]
+    + ["cls/squad/output_weights", "cls/squad/output_bias", "cls/squad/output_weights_sgm", "cls/squad/output_bias_sgm"]
+    + ["bert/encoder/layer_0/output/dense/kernel/adam_m", "bert/encoder/layer_0/output/dense/kernel/adam_v",
+       "global_step"]
+)
+SQUAD = {"data": [{"paragraphs": [
+    {"context": "MDM2 binds to the transactivation domain of p53 and inhibits its activity.",
+     "qas": [{"id": "q1", "question": "Which protein binds to p53?"},
+             {"id": "q2", "question": "Does MDM2 inhibit p53?"}]},
+    {"context": "Imatinib is a tyrosine kinase inhibitor used to treat chronic myeloid leukemia.",
+     "qas": [{"id": "q3", "question": "Which disease is treated with imatinib?"}]},
+]}]}
+
+
+@pytest.mark.parametrize("question_type", ["factoid", "list", "yesno"])
+def test_torch_name_maps_every_parameter_once(question_type):
+    state = torch_qa.model_class(question_type)(BertConfig(**TINY_CONFIG)).state_dict()
+    mapped = [torch_qa.torch_name(tf_name, question_type) for tf_name in TF_VARIABLES]
+    loaded = [name for name in mapped if name in state]
+    assert len(loaded) == len(set(loaded))
+    parameters = [name for name in state if not name.endswith("position_ids")]
+    assert sorted(loaded) == sorted(parameters)
+
+
+def test_torch_name_skips_optimizer_slots_and_other_heads():
+    assert torch_qa.torch_name("bert/encoder/layer_0/output/dense/kernel/adam_m", "factoid") is None
+    assert torch_qa.torch_name("global_step", "factoid") is None
+    assert torch_qa.torch_name("cls/squad/output_weights_sgm", "factoid") is None
+    assert torch_qa.torch_name("cls/squad/output_weights", "yesno") is None
+    assert torch_qa.torch_name("bert/encoder/layer_3/attention/self/query/kernel", "list") == \
+        "bert.encoder.layer.3.attention.self.query.weight"
+
+
+@pytest.mark.parametrize("question_type", ["factoid", "list", "yesno"])
+def test_torch_answers_match_tensorflow(question_type, tmp_path):
+    if importlib.util.find_spec("tensorflow") is None:
+        pytest.skip("TensorFlow is not installed")
+    if not os.path.isdir(os.path.join(BERT_DIR, "new_weights", question_type)):
+        pytest.skip(f"no {question_type} checkpoint under {BERT_DIR}")
+    torch_qa.convert_checkpoint(question_type, str(tmp_path), BERT_DIR)
+    max_diff, agreement = torch_qa.parity_check(question_type, SQUAD, str(tmp_path), BERT_DIR)
+    assert max_diff <= 1e-3
+    assert agreement == 1.0